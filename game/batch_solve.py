@@ -0,0 +1,217 @@
+import random
+import sys
+
+import numpy as np
+
+from . import gen_grid_list
+from .gen_grid import gen_grid
+from .lexicon import ALPHABET_SIZE, TERMINAL, ROW_SIZE, LETTER_CODES
+from .topology import get_topology
+
+# Solves many boards of the same level at once. Instead of a DFS per board,
+# the search frontier of every board advances one letter at a time as a set
+# of NumPy arrays (board, cell, lexicon node, visited mask, ...).
+#
+# Words are identified by their rank in the lexicon (the number of words
+# that sort before them), which the walk accumulates as it goes, so words
+# only need to be spelled out when wordlists are asked for.
+
+# extra transition columns: a 'qu' cell, and a cell that is never part of
+# a word ('#' or the padding used for missing neighbors)
+CODE_QU = ALPHABET_SIZE
+CODE_BLOCKED = ALPHABET_SIZE + 1
+NUM_CODES = ALPHABET_SIZE + 2
+
+# boards solved together; bounds the size of the frontier arrays
+CHUNK_SIZE = 256
+
+class BatchLexicon:
+    def __init__(self, lexicon):
+        table = np.frombuffer(lexicon.table, dtype=np.uint32).reshape(-1, ROW_SIZE)
+        num_nodes = table.shape[0]
+        self.root = lexicon.root
+        self.terminal = table[:, TERMINAL].astype(bool)
+
+        children = table[:, :ALPHABET_SIZE].astype(np.int64)
+        # children always have smaller ids, so counts can be filled in order
+        counts = np.zeros(num_nodes, dtype=np.int64)
+        for node in range(1, num_nodes):
+            counts[node] = self.terminal[node] + counts[children[node]].sum()
+        self.counts = counts
+        self.children = children
+
+        # rank offset for taking a letter: the word ending here (if any)
+        # plus every word under an earlier letter
+        offsets = self.terminal[:, None] + np.cumsum(counts[children], axis=1) - counts[children]
+
+        q, u = LETTER_CODES['q'], LETTER_CODES['u']
+        self.next = np.zeros((num_nodes, NUM_CODES), dtype=np.int64)
+        self.next[:, :ALPHABET_SIZE] = children
+        self.next[:, CODE_QU] = children[children[:, q], u]
+        self.offset = np.zeros((num_nodes, NUM_CODES), dtype=np.int64)
+        self.offset[:, :ALPHABET_SIZE] = offsets
+        self.offset[:, CODE_QU] = offsets[:, q] + offsets[children[:, q], u]
+
+        # plain lists are much faster than arrays for the scalar walk below
+        self.word_children = children.tolist()
+        self.word_counts = counts.tolist()
+        self.word_terminal = self.terminal.tolist()
+
+    # the word with the given rank
+    def word_at(self, rank):
+        node = self.root
+        word = []
+        while True:
+            if self.word_terminal[node]:
+                if rank == 0:
+                    return ''.join(word)
+                rank -= 1
+            for code, child in enumerate(self.word_children[node]):
+                if rank < self.word_counts[child]:
+                    word.append(chr(ord('a') + code))
+                    node = child
+                    break
+                rank -= self.word_counts[child]
+
+batch_lexicon = None
+
+def get_batch_lexicon():
+    global batch_lexicon
+    if batch_lexicon is None:
+        if gen_grid_list.lexicon is None:
+            gen_grid_list.gen_lexicon()
+        batch_lexicon = BatchLexicon(gen_grid_list.lexicon)
+    return batch_lexicon
+
+def grid_code(letter):
+    if letter == 'qu':
+        return CODE_QU
+    if letter in LETTER_CODES:
+        return LETTER_CODES[letter]
+    return CODE_BLOCKED
+
+def score_lengths(lengths):
+    return np.where(
+        lengths <= 6,
+        (lengths-2)*(lengths-3)*5+10,
+        lengths*40-170
+    )
+
+# returns (board index, word rank, score) of every distinct word found,
+# keeping the best score for each
+def _solve_chunk(lex, topology, grids, bonuses):
+    num_boards = len(grids)
+    num_cells = len(topology.cells)
+    # the padding cell num_cells is blocked on every board
+    codes = np.full((num_boards, num_cells + 1), CODE_BLOCKED, dtype=np.int64)
+    mults = np.ones((num_boards, num_cells + 1), dtype=np.int64)
+    for b, (grid, bonus) in enumerate(zip(grids, bonuses)):
+        codes[b, :num_cells] = [grid_code(letter) for letter in topology.flatten(grid)]
+        mults[b, :num_cells] = [bonus.get(cell, 1) for cell in topology.cells]
+    code_lengths = np.ones(NUM_CODES, dtype=np.int64)
+    code_lengths[CODE_QU] = 2
+
+    max_neighbors = max(len(ns) for ns in topology.neighbors)
+    neighbors = np.full((num_cells, max_neighbors), num_cells, dtype=np.int64)
+    for cell, ns in enumerate(topology.neighbors):
+        neighbors[cell, :len(ns)] = ns
+
+    board, cell = np.nonzero(codes[:, :num_cells] != CODE_BLOCKED)
+    code = codes[board, cell]
+    node = lex.next[lex.root, code]
+    rank = lex.offset[lex.root, code]
+    length = code_lengths[code]
+    mult = mults[board, cell]
+    mask = np.left_shift(np.uint64(1), cell.astype(np.uint64))
+
+    found_boards, found_ranks, found_scores = [], [], []
+    keep = node != 0
+    while True:
+        board, cell, node, rank, length, mult, mask = (
+            board[keep], cell[keep], node[keep], rank[keep],
+            length[keep], mult[keep], mask[keep]
+        )
+        if len(node) == 0:
+            break
+
+        done = lex.terminal[node]
+        found_boards.append(board[done])
+        found_ranks.append(rank[done])
+        found_scores.append(score_lengths(length[done]) * mult[done])
+
+        # extend every state by each of its unvisited neighbors
+        ncell = neighbors[cell]
+        visited = (mask[:, None] >> ncell.astype(np.uint64)) & np.uint64(1)
+        ncode = np.where(visited != 0, CODE_BLOCKED, codes[board[:, None], ncell])
+        nnode = lex.next[node[:, None], ncode]
+
+        parent, slot = np.nonzero(nnode != 0)
+        ncell = ncell[parent, slot]
+        ncode = ncode[parent, slot]
+        board = board[parent]
+        cell = ncell
+        rank = rank[parent] + lex.offset[node[parent], ncode]
+        node = nnode[parent, slot]
+        length = length[parent] + code_lengths[ncode]
+        mult = mult[parent] * mults[board, ncell]
+        mask = mask[parent] | np.left_shift(np.uint64(1), ncell.astype(np.uint64))
+        keep = slice(None)
+
+    if len(found_boards) == 0:
+        # no cell starts a word on any board
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+    board = np.concatenate(found_boards)
+    rank = np.concatenate(found_ranks)
+    score = np.concatenate(found_scores)
+
+    # keep the best score per (board, word)
+    order = np.lexsort((-score, rank, board))
+    board, rank, score = board[order], rank[order], score[order]
+    first = np.ones(len(board), dtype=bool)
+    first[1:] = (board[1:] != board[:-1]) | (rank[1:] != rank[:-1])
+    return board[first], rank[first], score[first]
+
+# Solves grids (all of one solver level, with bonuses[i] applying to
+# grids[i]). Returns (word counts, max scores, wordlists), where
+# wordlists[i] maps each word on grids[i] to its best score, like
+# _get_score_dict but in alphabetical order. Pass wordlists=False to skip
+# spelling out the words when only the totals are needed.
+def solve_batch(grids, level, bonuses, wordlists=True):
+    lex = get_batch_lexicon()
+    topology = get_topology(level)
+
+    counts = np.zeros(len(grids), dtype=np.int64)
+    max_scores = np.zeros(len(grids), dtype=np.int64)
+    all_words = [{} for grid in grids] if wordlists else None
+    for start in range(0, len(grids), CHUNK_SIZE):
+        end = min(start + CHUNK_SIZE, len(grids))
+        board, rank, score = _solve_chunk(lex, topology, grids[start:end], bonuses[start:end])
+        counts[start:end] = np.bincount(board, minlength=end-start)
+        max_scores[start:end] = np.bincount(board, weights=score, minlength=end-start)
+        if wordlists:
+            for b, r, sc in zip(board.tolist(), rank.tolist(), score.tolist()):
+                all_words[start + b][lex.word_at(r)] = sc
+
+    return counts.tolist(), max_scores.tolist(), all_words
+
+# word counts of the first grid generated from each seed, for calibrating
+# the gen_game_spec cutoff
+#
+# usage: python -m game.batch_solve [number of seeds]
+def main(argv):
+    num_seeds = int(argv[1]) if len(argv) > 1 else 1000
+    for level in range(4):
+        grids, bonuses = [], []
+        for seed in range(num_seeds):
+            grid, bonus, special = gen_grid(level, random.Random(seed))
+            grids.append(grid)
+            bonuses.append(bonus)
+        counts, max_scores, wordlists = solve_batch(grids, level, bonuses, wordlists=False)
+        counts.sort()
+        print('level %d: words min %d, median %d, max %d' % (
+            level, counts[0], counts[len(counts) // 2], counts[-1]
+        ))
+
+if __name__ == '__main__':
+    main(sys.argv)
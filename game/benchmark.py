@@ -0,0 +1,290 @@
+import argparse
+import datetime
+import gc
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from . import gen_grid_list
+from .game import (
+    BoggleGameState, from_durable, gen_game_spec, game_spec_cache,
+    make_db, make_db_writer, to_durable,
+)
+from .gen_grid import gen_grid
+from .gen_grid_list import _get_score_dict, gen_lexicon, read_words, SOLVER_ENGINES
+from .lexicon import Lexicon
+from .spec_gen import gen_game_spec_grids
+from .topology import get_game_topology_level
+
+# Times the expensive parts of the game on fixed seeds, so runs on the
+# same machine are comparable. Results can be saved as a JSON baseline
+# and later runs compared against it: a benchmark whose median is more
+# than --tolerance slower than the baseline's is a regression, and makes
+# the run exit with status 1.
+#
+# Only compare runs from the same machine; baselines aren't portable.
+#
+# usage: python -m game.benchmark [--save FILE] [--baseline FILE]
+#     [--tolerance FRACTION] [--repeat N] [--filter TEXT]
+
+BASELINE_VERSION = 1
+# seeds of the boards and specs benchmarked, per level
+SEEDS = range(20)
+# teams saved per flush by bench_persistence
+PERSISTENCE_TEAMS = 100
+# handle_word latency is reported for words found in these ranges
+FOUND_RANGES = [(0, 25), (25, 50), (50, 100), (100, 200), (200, 400), (400, 800)]
+
+# calls of quick functions timed together, see measure
+QUICK_CALLS = 100
+
+# runs func repeat times and returns the seconds each run took; with
+# number, a run is that many calls and the seconds per call are returned
+def measure(func, repeat, number=1):
+    gc.collect()
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        for j in range(number):
+            func()
+        times.append((time.perf_counter() - start) / number)
+    return times
+
+def summarize(times, **info):
+    result = {
+        'median': statistics.median(times),
+        'min': min(times),
+        'runs': len(times),
+    }
+    result.update(info)
+    return result
+
+def make_boards(level):
+    gen_level = get_game_topology_level(level)
+    return gen_level, [gen_grid(gen_level, random.Random(seed)) for seed in SEEDS]
+
+# seconds per load of a prebuilt file, and per build from the word list
+# for when there is none
+def bench_lexicon_load(results, repeat):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'lexicon.lex')
+        Lexicon.from_words(read_words()).save(path)
+        results['lexicon_load/mmap'] = summarize(
+            measure(lambda: Lexicon.load(path), repeat, QUICK_CALLS)
+        )
+    results['lexicon_load/build'] = summarize(
+        measure(lambda: Lexicon.from_words(read_words()), repeat)
+    )
+
+# seconds per board
+def bench_solve(results, repeat):
+    for level in range(4):
+        gen_level, boards = make_boards(level)
+        for engine in SOLVER_ENGINES:
+            def solve():
+                for grid, bonuses, special in boards:
+                    _get_score_dict(grid, gen_level, bonuses, engine=engine)
+            times = [t / len(boards) for t in measure(solve, repeat)]
+            results['solve/level%d/%s' % (level, engine)] = summarize(times)
+
+# seconds per spec, including grids that were rejected and generated again
+def bench_gen_game_spec(results, repeat):
+    for level in range(4):
+        grids_before = gen_game_spec_grids.values.get((level,), 0)
+        def gen():
+            for seed in SEEDS:
+                gen_game_spec(level, seed)
+        times = [t / len(SEEDS) for t in measure(gen, repeat)]
+        grids = gen_game_spec_grids.values.get((level,), 0) - grids_before
+        results['gen_game_spec/level%d' % (level,)] = summarize(
+            times, grids_per_spec=grids / (len(SEEDS) * repeat)
+        )
+
+# a game of level that is running with the spec of seed
+def make_running_game(state, level, seed):
+    game_data = state.make_init()
+    game_data['max_level'] = 4
+    game_data['num_games'] = 1
+    game_data['running'] = True
+    game_data['start_time'] = datetime.datetime.now().timestamp()
+    game_data['seed'] = seed
+    game_data['level'] = level
+    game_data['words'] = []
+    game_data['found'] = set()
+    game_data['score'] = 0
+    return game_data
+
+def get_spec(level, seed):
+    game_spec = gen_game_spec(level, seed)
+    game_spec_cache.put((level, seed), game_spec)
+    return game_spec
+
+# seconds per word message, by how many words were found before it; each
+# word of the spec is played once, followed by a wrong and a duplicate
+# word
+def bench_handle_word(results, repeat):
+    seed = SEEDS[0]
+    for level in range(4):
+        game_spec = get_spec(level, seed)
+        words = [word for word, score in game_spec.wordlist]
+        # index of the found range -> seconds per word, for every run
+        times = {}
+        for i in range(repeat):
+            state = BoggleGameState('benchmark')
+            game_data = make_running_game(state, level, seed)
+            run_times = {}
+            for num_found, word in enumerate(words):
+                msgs = [
+                    {'type': 'word', 'word': word, 'numGames': 1},
+                    {'type': 'word', 'word': word + 'q', 'numGames': 1},
+                    {'type': 'word', 'word': word, 'numGames': 1},
+                ]
+                start = time.perf_counter()
+                for msg in msgs:
+                    state.handle(game_data, msg)
+                    if state.new_game_data is not None:
+                        game_data = state.new_game_data
+                elapsed = (time.perf_counter() - start) / len(msgs)
+                for j, (low, high) in enumerate(FOUND_RANGES):
+                    if low <= num_found < high:
+                        run_times.setdefault(j, []).append(elapsed)
+            for j, word_times in run_times.items():
+                times.setdefault(j, []).append(statistics.mean(word_times))
+        for j, range_times in sorted(times.items()):
+            low, high = FOUND_RANGES[j]
+            results['handle_word/level%d/found%d-%d' % (level, low, high)] = summarize(range_times)
+
+# seconds per encoded full update of a game with all words found, and of
+# the update ending it
+def bench_full_update(results, repeat):
+    seed = SEEDS[0]
+    for level in range(4):
+        game_spec = get_spec(level, seed)
+        state = BoggleGameState('benchmark')
+        game_data = make_running_game(state, level, seed)
+        for word, score in game_spec.wordlist:
+            state.add_word(game_data, game_spec, word)
+        ended_data = from_durable(to_durable(game_data))
+        for compact in (False, True):
+            encoding = 'compact' if compact else 'json'
+            def encode_running():
+                for action in state.make_full_update(game_data):
+                    action.encode(compact=compact)
+            def encode_ended():
+                for action in state.make_full_update(ended_data, True, ended_spec=game_spec):
+                    action.encode(compact=compact)
+            results['full_update/level%d/running/%s' % (level, encoding)] = summarize(
+                measure(encode_running, repeat, QUICK_CALLS)
+            )
+            results['full_update/level%d/ended/%s' % (level, encoding)] = summarize(
+                measure(encode_ended, repeat, QUICK_CALLS)
+            )
+
+# seconds per flush of PERSISTENCE_TEAMS saved teams, and per team loaded
+def bench_persistence(results, repeat):
+    state = BoggleGameState('benchmark')
+    world = json.dumps(to_durable(state.make_init()))
+    teams = ['team%d' % (i,) for i in range(PERSISTENCE_TEAMS)]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'db.sqlite')
+        db = make_db(path)
+        db_writer = make_db_writer(path)
+        def save():
+            last_ping = datetime.datetime.now().timestamp()
+            for team in teams:
+                db_writer.put('boggle_team_data', team, (team, world, last_ping))
+            db_writer.flush()
+        def load():
+            c = db.cursor()
+            for team in teams:
+                c.execute('SELECT world FROM boggle_team_data WHERE team = ?', (team,))
+                json.loads(c.fetchone()[0])
+        results['persistence/save_flush'] = summarize(measure(save, repeat))
+        results['persistence/load'] = summarize(
+            [t / len(teams) for t in measure(load, repeat)]
+        )
+        db_writer.close()
+        db.close()
+
+BENCHMARKS = [
+    ('lexicon_load', bench_lexicon_load),
+    ('solve', bench_solve),
+    ('gen_game_spec', bench_gen_game_spec),
+    ('handle_word', bench_handle_word),
+    ('full_update', bench_full_update),
+    ('persistence', bench_persistence),
+]
+
+# names of the results that are slower than in baseline, with the ratio
+def find_regressions(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result['median'] / baseline[name]['median']
+        if ratio > 1 + tolerance:
+            regressions.append((name, ratio))
+    return regressions
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='python -m game.benchmark')
+    parser.add_argument('--save', help='save the results as a baseline to this file')
+    parser.add_argument('--baseline', help='compare the results with this baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+        help='slowdown over the baseline that is a regression (default 0.25)')
+    parser.add_argument('--repeat', type=int, default=5,
+        help='runs of each benchmark (default 5)')
+    parser.add_argument('--filter', default='',
+        help='only run the benchmarks whose name contains this')
+    args = parser.parse_args(argv[1:])
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('version') != BASELINE_VERSION:
+            print('%s is not a compatible baseline' % (args.baseline,))
+            return 2
+        baseline = baseline['results']
+
+    # loaded before it's timed, like in the server
+    gen_lexicon()
+    results = {}
+    for name, bench in BENCHMARKS:
+        if args.filter in name:
+            bench(results, args.repeat)
+    for name, result in results.items():
+        line = '%-40s %10.3f ms' % (name, result['median'] * 1000)
+        if baseline is not None and name in baseline:
+            line += '  %+6.1f%%' % ((result['median'] / baseline[name]['median'] - 1) * 100,)
+        if 'grids_per_spec' in result:
+            line += '  %.2f grids per spec' % (result['grids_per_spec'],)
+        print(line)
+
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'version': BASELINE_VERSION,
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'solver_engine': gen_grid_list.SOLVER_ENGINE,
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+        print('saved baseline to %s' % (args.save,))
+
+    if baseline is not None:
+        regressions = find_regressions(results, baseline, args.tolerance)
+        for name, ratio in regressions:
+            print('regression: %s is %.2fx the baseline' % (name, ratio))
+        if len(regressions) > 0:
+            return 1
+        print('no regressions')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,17 @@
+import sys
+
+from .gen_grid_list import read_words, lexiconPath
+from .lexicon import Lexicon
+
+# compiles the dictionary (plus Carroll words) into the binary file that
+# gen_grid_list maps at runtime; rerun whenever either word list changes
+#
+# usage: python -m game.build_lexicon [output path]
+def main(argv):
+    path = argv[1] if len(argv) > 1 else str(lexiconPath)
+    lexicon = Lexicon.from_words(read_words())
+    lexicon.save(path)
+    print('wrote %d nodes to %s' % (lexicon.num_nodes, path))
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,53 @@
+import random
+import sys
+
+from .game import TESTING_BOARDS
+from .gen_grid import gen_grid
+from .gen_grid_list import _get_score_dict, SOLVER_ENGINES
+
+try:
+    from .batch_solve import solve_batch
+except ImportError:
+    # numpy is only needed for the batch solver
+    solve_batch = None
+
+# checks that every solver engine gives exactly the same words, scores and
+# word order as the recursive one, on the testing boards and random seeds;
+# the batch solver is checked too, ignoring word order
+#
+# usage: python -m game.check_engines [number of seeds]
+def check_board(board, level, bonuses, what):
+    expected = list(_get_score_dict(board, level, bonuses, engine='recursive').items())
+    for engine in SOLVER_ENGINES:
+        actual = list(_get_score_dict(board, level, bonuses, engine=engine).items())
+        if actual != expected:
+            raise Exception('engine %s differs on %s' % (engine, what))
+
+def check_batch(grids, level, bonuses):
+    counts, max_scores, wordlists = solve_batch(grids, level, bonuses)
+    for i, (grid, bonus) in enumerate(zip(grids, bonuses)):
+        expected = _get_score_dict(grid, level, bonus, engine='recursive')
+        if sorted(wordlists[i].items()) != sorted(expected.items()):
+            raise Exception('batch solver differs on level %d board %d' % (level, i))
+        if counts[i] != len(expected) or max_scores[i] != sum(expected.values()):
+            raise Exception('batch totals differ on level %d board %d' % (level, i))
+
+def main(argv):
+    num_seeds = int(argv[1]) if len(argv) > 1 else 100
+    for level, board in enumerate(TESTING_BOARDS):
+        grids = [board]
+        bonuses = [{}]
+        check_board(board, level, {}, 'testing board %d' % (level,))
+        for seed in range(num_seeds):
+            grid, bonus, special = gen_grid(level, random.Random(seed))
+            grids.append(grid)
+            bonuses.append(bonus)
+            check_board(grid, level, bonus, 'level %d seed %d' % (level, seed))
+        if solve_batch is not None:
+            check_batch(grids, level, bonuses)
+    print('all %d engines agree' % (len(SOLVER_ENGINES),))
+    if solve_batch is None:
+        print('batch solver not checked (numpy is not installed)')
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,34 @@
+# short keys used instead of message keys by the compact encoding
+COMPACT_KEYS = {
+    'type': 't',
+    'word': 'w',
+    'grade': 'g',
+    'numGames': 'n',
+    'numWords': 'nw',
+    'score': 's',
+    'maxLevel': 'ml',
+    'running': 'r',
+    'trophies': 'tr',
+    'roundTrophies': 'rt',
+    'blanks': 'b',
+    'stats': 'st',
+    'level': 'l',
+    'timeLeft': 'tl',
+    'totTime': 'tt',
+    'words': 'ws',
+    'grid': 'gr',
+    'bonuses': 'bo',
+    'totNumWords': 'tn',
+    'maxScore': 'ms',
+    'debugSeed': 'ds',
+    'allWords': 'aw',
+    'allWordsZ': 'az',
+    'hiscores': 'h',
+    'grades': 'gs',
+    'newWords': 'wn',
+    'version': 'v',
+}
+
+# version of the delta messages; clients that AUTH with "deltas" set to
+# it are sent deltas instead of full updates when words are found
+DELTA_VERSION = 1
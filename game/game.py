@@ -1,16 +1,47 @@
+import atexit
 import datetime
 import random
 import os
 import sqlite3
 import json
+import threading
+import time
+import zlib
+import base64
 
 from .validate import Validator as V
 from .gen_grid_list import _get_score_dict
-from .gen_grid import gen_grid
-
-def make_db():
-    os.makedirs('db', exist_ok=True)
-    db = sqlite3.connect('db/db.sqlite')
+from .encoding import COMPACT_KEYS, DELTA_VERSION
+from .spec_gen import gen_spec, open_spec_store, store_spec, load_spec
+from .spec_pool import GameSpecPool
+from .spec_cache import GameSpecCache
+from .write_behind import WriteBehind
+from .leaderboard import Leaderboard
+from .metrics import Counter, Gauge, Histogram
+
+DB_PATH = 'db/db.sqlite'
+# seconds between flushes of buffered writes, see db_writer
+DB_FLUSH_INTERVAL = 1
+# buffered writes that trigger a flush before the interval is over
+DB_FLUSH_MAX_PENDING = 100
+# compact_db keeps the TEAM_DATA_KEPT most recently saved teams and the
+# best HISCORES_KEPT teams of each level
+TEAM_DATA_KEPT = 100
+HISCORES_KEPT = 100
+# specs kept in game_spec_store by compact_db
+SPECS_KEPT = 10000
+# seconds between runs of compact_db, see start_db_compaction
+DB_COMPACTION_INTERVAL = 60
+# seconds after which leaderboards are loaded again, to see hiscores set
+# by other processes; None if no other process sets any
+LEADERBOARD_RELOAD_INTERVAL = None
+
+def make_db(path=DB_PATH):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # reducers may run on executor threads, see db_lock
+    db = sqlite3.connect(path, check_same_thread=False)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
 
     db.execute(' '.join([
         'CREATE TABLE IF NOT EXISTS boggle_team_data (',
@@ -19,6 +50,10 @@ def make_db():
         'last_ping INTEGER NOT NULL',
         ')',
     ]))
+    db.execute(' '.join([
+        'CREATE INDEX IF NOT EXISTS boggle_team_data_last_ping',
+        'ON boggle_team_data (last_ping)',
+    ]))
 
     db.execute(' '.join([
         'CREATE TABLE IF NOT EXISTS boggle_high_scores (',
@@ -28,70 +63,283 @@ def make_db():
         'UNIQUE(team, level)',
         ')',
     ]))
+    db.execute(' '.join([
+        'CREATE INDEX IF NOT EXISTS boggle_high_scores_level_score',
+        'ON boggle_high_scores (level, score)',
+    ]))
 
     return db
 
-db = make_db()
-
-def get_hiscore(team, level):
-    c = db.cursor()
-    c.execute(' '.join([
-        'SELECT score FROM boggle_high_scores',
-        'WHERE team = ? AND level = ?',
-    ]), (team, level))
-    return c.fetchone()
-
-def get_all_hiscores(level):
-    c = db.cursor()
-    c.execute(' '.join([
-        'SELECT team, score FROM boggle_high_scores',
-        'WHERE level = ?',
-        'ORDER BY score DESC',
-    ]), (level,))
-    return list(c.fetchall())
-
-def get_hiscores_check(team, level):
-    # if get_hiscore(team, level) is None:
-    #     return None
-    return get_all_hiscores(level)
+# the database and db_writer are opened when first used (see get_db and
+# get_db_writer), so importing this module, e.g. for game/benchmark.py,
+# doesn't create them
+db = None
+# must be held while using db
+db_lock = threading.RLock()
+
+def get_db():
+    global db
+    with db_lock:
+        if db is None:
+            db = make_db()
+    return db
 
-def set_hiscore(team, level, score):
-    old_entry = get_hiscore(team, level)
-    if old_entry is None or score > old_entry[0]:
-        db.execute(' '.join([
+# All writes go through db_writer, which writes them in the background, so
+# reads have to check it for rows that aren't written yet.
+def make_db_writer(path=DB_PATH):
+    db_writer = WriteBehind(path, DB_FLUSH_INTERVAL, DB_FLUSH_MAX_PENDING)
+    db_writer.add_table(
+        'boggle_team_data',
+        ' '.join([
+            'INSERT OR REPLACE INTO boggle_team_data',
+            '(team, world, last_ping)',
+            'VALUES (?, ?, ?)'
+        ]),
+    )
+    db_writer.add_table(
+        'boggle_high_scores',
+        ' '.join([
             'INSERT OR REPLACE INTO boggle_high_scores',
             '(team, level, score)',
             'VALUES (?, ?, ?)'
-        ]), (team, level, score))
-        db.execute(' '.join([
-            'DELETE FROM boggle_high_scores',
-            'WHERE level = ?',
-            'ORDER BY score DESC',
-            'LIMIT 200',
-            'OFFSET 100',
-        ]), (level,))
-        db.commit()
+        ]),
+    )
+    return db_writer
+
+db_writer = None
+db_writer_lock = threading.Lock()
+
+def get_db_writer():
+    global db_writer
+    # it writes to the tables make_db creates
+    get_db()
+    with db_writer_lock:
+        if db_writer is None:
+            db_writer = make_db_writer()
+            atexit.register(db_writer.close)
+    return db_writer
+
+# flushes db_writer's writes and stops it, if it was opened
+def close_db_writer():
+    with db_writer_lock:
+        if db_writer is not None:
+            db_writer.close()
+
+def get_db_writer_stats():
+    if db_writer is None:
+        return {'pending': 0, 'flushes': 0, 'rows_written': 0, 'errors': 0}
+    return db_writer.stats()
+
+# for monitoring compact_db
+db_compaction_stats = {
+    'runs': 0,
+    'errors': 0,
+    'team_data_deleted': 0,
+    'high_scores_deleted': 0,
+    'specs_deleted': 0,
+    'last_duration': None,
+}
+
+Counter(
+    'boggle_db_compactions_total', 'Runs of compact_db',
+    func=lambda: db_compaction_stats['runs']
+)
+Counter(
+    'boggle_db_compaction_errors_total', 'Failed runs of compact_db',
+    func=lambda: db_compaction_stats['errors']
+)
+Counter(
+    'boggle_db_compaction_deleted_rows_total', 'Rows deleted by compact_db',
+    ['table'],
+    func=lambda: {
+        ('boggle_team_data',): db_compaction_stats['team_data_deleted'],
+        ('boggle_high_scores',): db_compaction_stats['high_scores_deleted'],
+        ('boggle_game_specs',): db_compaction_stats['specs_deleted'],
+    }
+)
+compaction_seconds = Histogram('boggle_db_compaction_seconds', 'Time taken by compact_db')
+Gauge(
+    'boggle_db_pending_rows', 'Rows buffered by db_writer',
+    func=lambda: get_db_writer_stats()['pending']
+)
+Counter(
+    'boggle_db_written_rows_total', 'Rows written by db_writer',
+    func=lambda: get_db_writer_stats()['rows_written']
+)
+Counter(
+    'boggle_db_flush_errors_total', 'Failed db_writer flushes',
+    func=lambda: get_db_writer_stats()['errors']
+)
+
+# Deletes all but the rows that are kept (see TEAM_DATA_KEPT,
+# HISCORES_KEPT and SPECS_KEPT), so writes don't have to. Each table is
+# cut at the value of its last kept row, found and deleted through the
+# indexes; rows tied with it are kept as well.
+#
+# It uses its own connection, so with WAL the loop can keep reading
+# through db while it runs.
+def compact_db():
+    start = datetime.datetime.now()
+    team_data_deleted = 0
+    high_scores_deleted = 0
+    # the tables may not be created yet
+    get_db()
+    # waits for db_writer's flushes rather than failing
+    compaction_db = sqlite3.connect(DB_PATH, timeout=10)
+    try:
+        # committed, or rolled back if anything fails
+        with compaction_db:
+            c = compaction_db.cursor()
+            c.execute(' '.join([
+                'SELECT last_ping FROM boggle_team_data',
+                'ORDER BY last_ping DESC',
+                'LIMIT 1 OFFSET ?',
+            ]), (TEAM_DATA_KEPT - 1,))
+            entry = c.fetchone()
+            if entry is not None:
+                c.execute(' '.join([
+                    'DELETE FROM boggle_team_data',
+                    'WHERE last_ping < ?',
+                ]), entry)
+                team_data_deleted += c.rowcount
+            for level in range(4):
+                c.execute(' '.join([
+                    'SELECT score FROM boggle_high_scores',
+                    'WHERE level = ?',
+                    'ORDER BY score DESC',
+                    'LIMIT 1 OFFSET ?',
+                ]), (level, HISCORES_KEPT - 1))
+                entry = c.fetchone()
+                if entry is not None:
+                    c.execute(' '.join([
+                        'DELETE FROM boggle_high_scores',
+                        'WHERE level = ? AND score < ?',
+                    ]), (level, entry[0]))
+                    high_scores_deleted += c.rowcount
+    finally:
+        compaction_db.close()
+    specs_deleted = 0
+    if game_spec_store is not None:
+        specs_deleted = game_spec_store.compact(SPECS_KEPT)
+    db_compaction_stats['runs'] += 1
+    db_compaction_stats['team_data_deleted'] += team_data_deleted
+    db_compaction_stats['high_scores_deleted'] += high_scores_deleted
+    db_compaction_stats['specs_deleted'] += specs_deleted
+    db_compaction_stats['last_duration'] = (datetime.datetime.now() - start).total_seconds()
+    compaction_seconds.observe(db_compaction_stats['last_duration'])
+    if team_data_deleted > 0 or high_scores_deleted > 0 or specs_deleted > 0:
+        print('compacted db: %d team data, %d hiscore and %d spec rows deleted' % (
+            team_data_deleted, high_scores_deleted, specs_deleted
+        ))
+
+def run_db_compaction():
+    while True:
+        time.sleep(DB_COMPACTION_INTERVAL)
+        try:
+            compact_db()
+        except sqlite3.Error as e:
+            db_compaction_stats['errors'] += 1
+            print('failed to compact db: %r' % (e,))
+
+# runs compact_db every DB_COMPACTION_INTERVAL seconds in the background
+def start_db_compaction():
+    threading.Thread(target=run_db_compaction, daemon=True).start()
+
+# level -> Leaderboard, loaded when first needed
+leaderboards = {}
+# level -> when its leaderboard was loaded
+leaderboards_loaded = {}
+leaderboards_lock = threading.Lock()
+
+# called with leaderboards_lock held
+def needs_leaderboard_load(level, now):
+    if level not in leaderboards:
+        return True
+    return (
+        LEADERBOARD_RELOAD_INTERVAL is not None and
+        now - leaderboards_loaded[level] >= LEADERBOARD_RELOAD_INTERVAL
+    )
+
+# whether get_leaderboard(level) would load it from the database
+def is_leaderboard_loaded(level):
+    with leaderboards_lock:
+        return not needs_leaderboard_load(level, time.time())
+
+def get_leaderboard(level):
+    now = time.time()
+    with leaderboards_lock:
+        if needs_leaderboard_load(level, now):
+            with db_lock:
+                c = get_db().cursor()
+                c.execute(' '.join([
+                    'SELECT team, score FROM boggle_high_scores',
+                    'WHERE level = ?',
+                    'ORDER BY score DESC',
+                    'LIMIT ?',
+                ]), (level, HISCORES_KEPT))
+                entries = list(c.fetchall())
+            leaderboard = Leaderboard(HISCORES_KEPT, entries)
+            # and what this process hasn't written yet
+            for team, entry_level, score in get_db_writer().rows('boggle_high_scores'):
+                if entry_level == level:
+                    leaderboard.update(team, score)
+            leaderboards[level] = leaderboard
+            leaderboards_loaded[level] = now
+        return leaderboards[level]
+
+def set_hiscore(team, level, score):
+    if get_leaderboard(level).update(team, score):
+        get_db_writer().put('boggle_high_scores', (team, level), (team, level, score))
 
 def save_data(team, game_data):
     world = json.dumps(to_durable(game_data))
     last_ping = datetime.datetime.now().timestamp()
-    db.execute(' '.join([
-        'INSERT OR REPLACE INTO boggle_team_data',
-        '(team, world, last_ping)',
-        'VALUES (?, ?, ?)'
-    ]), (team, world, last_ping))
-    db.execute(' '.join([
-        'DELETE FROM boggle_team_data',
-        'ORDER BY last_ping DESC',
-        'LIMIT 200',
-        'OFFSET 100',
-    ]))
-    db.commit()
+    get_db_writer().put('boggle_team_data', team, (team, world, last_ping))
+
+# the durable data saved for team, or None
+def load_data(team):
+    entry = get_db_writer().get('boggle_team_data', team)
+    if entry is not None:
+        return json.loads(entry[1])
+    with db_lock:
+        c = get_db().cursor()
+        c.execute(' '.join([
+            'SELECT world FROM boggle_team_data',
+            'WHERE team = ?'
+        ]), (team,))
+        entry = c.fetchone()
+    if entry is None:
+        return None
+    return json.loads(entry[0])
 
 class BoggleAction:
-    def __init__(self, broadcast, data):
+    def __init__(self, broadcast, data, fragments=(), deltas=None):
         self.broadcast = broadcast
         self.data = data
+        # (key, already encoded value) members of the message, which are
+        # spliced into the encoded data instead of being encoded again
+        self.fragments = fragments
+        # for broadcasts: True if only for clients that accept deltas,
+        # False if only for those that don't, None if for all
+        self.deltas = deltas
+
+    # with compact, keys are replaced by COMPACT_KEYS and there is no
+    # whitespace
+    def encode(self, compact=False):
+        if compact:
+            text = json.dumps(
+                {COMPACT_KEYS.get(k, k): v for k, v in self.data.items()},
+                separators=(',', ':')
+            )
+            keys = COMPACT_KEYS
+        else:
+            text = json.dumps(self.data)
+            keys = {}
+        if len(self.fragments) == 0:
+            return text
+        return text[:-1] + ''.join(
+            ',"%s":%s' % (keys.get(k, k), v) for k, v in self.fragments
+        ) + '}'
 
     @staticmethod
     def make_respond(data):
@@ -158,6 +406,16 @@ class BoggleGameSpec:
         self.bonuses = bonuses
         self.wordlist = wordlist
         self.special = special
+        # word -> score, for grading
+        self.word_scores = dict(wordlist)
+        self.max_score = sum(score for word, score in wordlist)
+        self.num_words = len(wordlist)
+        # what each trophy's progress is compared with, see gets_trophy
+        self.trophy_targets = get_trophy_targets(self)
+        # message fragments, built when first needed; see
+        # get_static_fragments and get_all_words_fragment
+        self.static_fragments = None
+        self.all_words_fragment = None
 
     @staticmethod
     def get_testing_spec(level):
@@ -174,72 +432,117 @@ class BoggleGameSpec:
             wordlist[0][0]
         )
 
+    # the members of a full update that only depend on the spec
+    def get_static_fragments(self):
+        if self.static_fragments is None:
+            self.static_fragments = [
+                (k, json.dumps(v, separators=(',', ':'))) for k, v in [
+                    ('grid', self.grid),
+                    ('bonuses', [[k, v] for k, v in self.bonuses.items()]),
+                    ('totNumWords', self.num_words),
+                    ('maxScore', self.max_score),
+                ]
+            ]
+        return self.static_fragments
+
+    # the allWords member sent when the round ends, or with
+    # COMPRESS_ALL_WORDS an allWordsZ member instead, holding the
+    # base64 of the zlib compressed allWords list
+    def get_all_words_fragment(self):
+        if self.all_words_fragment is None:
+            # the special word is sent too, whether or not it was found
+            all_words = json.dumps(self.wordlist, separators=(',', ':'))
+            if COMPRESS_ALL_WORDS:
+                blob = base64.b64encode(zlib.compress(all_words.encode()))
+                self.all_words_fragment = ('allWordsZ', '"%s"' % blob.decode())
+            else:
+                self.all_words_fragment = ('allWords', all_words)
+        return self.all_words_fragment
+
 DATABASE_VERSION = 4
 ANSWER = 'NOHTDORUWEAARLDN'
 HISCORE_SCALE = 100000
 
 CACHE_SIZE = 100
-game_spec_cache = {}
+# seconds a spec that isn't pinned may go unused before it is dropped
+CACHE_TTL = None
+# how long past its time limit a running game's spec stays pinned
+CACHE_PIN_GRACE = datetime.timedelta(minutes=1)
+# send the words of a finished round compressed, for clients that
+# understand allWordsZ
+COMPRESS_ALL_WORDS = False
 
 def gen_game_spec(level, seed):
-    cutoff = 105
-    invalid_grid = True
-    rand_obj = random.Random(seed)
-
-    gen_level = [0, 1, 3, 2][level]
-    while invalid_grid:
-        grid, bonuses, special = gen_grid(gen_level, rand_obj)
-        wordlist = [
-            (word, score) for word, score in
-            _get_score_dict(grid, gen_level, bonuses).items()
-        ]
-        if len(wordlist) >= cutoff:
-            invalid_grid = False
-        else:
-            cutoff -= 5
-
-    return BoggleGameSpec(
-        level, grid, bonuses, wordlist, special
-    )
+    return BoggleGameSpec(level, *gen_spec(level, seed))
+
+# specs solved by any process on this host are kept here; None to disable
+SPEC_STORE_PATH = 'db/specs.sqlite'
+game_spec_store = open_spec_store(SPEC_STORE_PATH)
+
+def store_game_spec(seed, game_spec):
+    store_spec(game_spec_store, game_spec.level, seed, (
+        game_spec.grid, game_spec.bonuses, game_spec.wordlist, game_spec.special
+    ))
+
+# reuses a spec solved before (maybe by another process) if possible
+def load_game_spec(level, seed):
+    return BoggleGameSpec(level, *load_spec(game_spec_store, level, seed))
+
+game_spec_cache = GameSpecCache(load_game_spec, CACHE_SIZE, CACHE_TTL)
+
+Gauge('boggle_spec_cache_size', 'Specs in game_spec_cache', func=lambda: len(game_spec_cache))
+Gauge(
+    'boggle_spec_cache_pinned', 'Specs pinned in game_spec_cache',
+    func=lambda: game_spec_cache.stats()['pinned']
+)
+Counter(
+    'boggle_spec_cache_lookups_total', 'game_spec_cache lookups', ['result'],
+    func=lambda: {
+        ('hit',): game_spec_cache.stats()['hits'],
+        ('miss',): game_spec_cache.stats()['misses'],
+    }
+)
+Counter(
+    'boggle_spec_cache_evictions_total', 'Specs evicted from game_spec_cache',
+    func=lambda: game_spec_cache.stats()['evictions']
+)
 
 def discard_game_spec_from_cache(game_data):
-    global game_spec_cache
-
     level = game_data['level']
     seed = game_data['seed']
     key = (level, seed)
-    game_spec_cache.pop(key, None)
+    game_spec_cache.discard(key)
 
 def get_game_spec(game_data):
-    global game_spec_cache
-
     level = game_data['level']
     seed = game_data['seed']
     key = (level, seed)
-    if key in game_spec_cache:
-        game_spec_cache[key] = (
-            datetime.datetime.now(),
-            game_spec_cache[key][1]
-        )
-    else:
-        if len(game_spec_cache) >= CACHE_SIZE:
-            game_spec_cache = {
-                k: v for k, v in
-                sorted([
-                    (k, v) for k, v in game_spec_cache.items()
-                ], key=lambda k: k[0], reverse=True)[:CACHE_SIZE//2]
-            }
-        game_spec_cache[key] = (
-            datetime.datetime.now(),
-            gen_game_spec(level, seed)
-        )
-    return game_spec_cache[key][1]
+    pin_until = None
+    if game_data['running']:
+        # keep it until the round is over
+        time_limit = TIME_LIMITS_PER_LEVEL[level] + CACHE_PIN_GRACE
+        pin_until = game_data['start_time'] + time_limit.total_seconds()
+    return game_spec_cache.get(key, pin_until)
+
+# number of ready specs kept per level by game_spec_pool
+SPEC_POOL_SIZE = 4
+game_spec_pool = GameSpecPool(gen_game_spec, range(4), SPEC_POOL_SIZE)
+
+# picks the seed for a new round, preferring one whose spec is ready
+def draw_game_seed(level):
+    entry = game_spec_pool.pop(level)
+    if entry is None:
+        return random.SystemRandom().randrange(1<<28)
+    seed, game_spec = entry
+    game_spec_cache.put((level, seed), game_spec)
+    store_game_spec(seed, game_spec)
+    return seed
 
 def get_total_score(game_spec, words):
     return sum([w[1] for w in words])
 
 def get_max_score(game_spec):
-    return sum([w[1] for w in game_spec.wordlist])
+    return game_spec.max_score
 
 TROPHY_THRESHOLDS = [
     [30, 50],
@@ -248,13 +551,17 @@ TROPHY_THRESHOLDS = [
     [20, 35],
 ]
 
-def gets_trophy_num(game_spec, words, threshold):
-    return len(words) >= len(game_spec.wordlist) * threshold
+def trophy_target_num(game_spec, threshold):
+    return game_spec.num_words * threshold
 
-def gets_trophy_points(game_spec, words, threshold):
-    score = get_total_score(game_spec, words)
-    max_score = get_max_score(game_spec)
-    return score >= max_score * threshold
+def trophy_target_points(game_spec, threshold):
+    return game_spec.max_score * threshold
+
+def gets_trophy_num(game_data, target):
+    return len(game_data['words']) >= target
+
+def gets_trophy_points(game_data, target):
+    return game_data['score'] >= target
 
 GETS_TROPHY_FUNCS = [
     gets_trophy_num,
@@ -263,26 +570,42 @@ GETS_TROPHY_FUNCS = [
     gets_trophy_points,
 ]
 
-def gets_trophy(game_data, index):
-    game_spec = get_game_spec(game_data)
-    level = game_spec.level
-    words = game_data['words']
-    threshold = TROPHY_THRESHOLDS[level][index // 2] / 100
-    return GETS_TROPHY_FUNCS[index](game_spec, words, threshold)
+TROPHY_TARGET_FUNCS = [
+    trophy_target_num,
+    trophy_target_points,
+    trophy_target_num,
+    trophy_target_points,
+]
+
+def get_trophy_targets(game_spec):
+    return [
+        TROPHY_TARGET_FUNCS[index](
+            game_spec,
+            TROPHY_THRESHOLDS[game_spec.level][index // 2] / 100
+        )
+        for index in range(len(TROPHY_TARGET_FUNCS))
+    ]
+
+def gets_trophy(game_spec, game_data, index):
+    target = game_spec.trophy_targets[index]
+    return GETS_TROPHY_FUNCS[index](game_data, target)
 
 # response codes to client words
 GRADE_WRONG = 0
 GRADE_DUPLICATE = 1
 GRADE_CORRECT = 2
+# most words a words message may carry
+MAX_WORDS_PER_MESSAGE = 100
 
 def game_get_max_score(game_data):
     return get_max_score(get_game_spec(game_data))
 
+# kept up to date as words are found
 def game_get_score(game_data):
-    return get_total_score(get_game_spec(game_data), game_data['words'])
+    return game_data['score']
 
 def game_get_max_num_words(game_data):
-    return len(get_game_spec(game_data).wordlist)
+    return get_game_spec(game_data).num_words
 
 def game_get_num_words(game_data):
     return len(game_data['words'])
@@ -292,7 +615,7 @@ def game_get_special(game_data):
 
 def game_get_found_special(game_data):
     special = game_get_special(game_data)
-    return len([w for w in game_data['words'] if w[0] == special]) > 0
+    return special in game_data['found']
 
 class BoggleStats:
     def __init__(self):
@@ -369,6 +692,8 @@ def from_durable(durable_data):
         'seed': None,
         'level': None,
         'words': None,
+        'found': None,
+        'score': None,
         'round_trophies': 0, # bitmask
         'trophies': durable_data['trophies'], # bitmask
         'stats': BoggleStats(),
@@ -376,10 +701,22 @@ def from_durable(durable_data):
     game_data['stats'].from_dict(durable_data['stats'])
     return game_data
 
+# by message type, for the types that are handled
+handle_seconds = Histogram(
+    'boggle_handle_seconds', 'Time taken by BoggleGameState.handle', ['type']
+)
+
 class BoggleGameState:
     def __init__(self, team):
         self.team = team
         self.new_game_data = None
+        self.reducers = {
+            'start': self.handle_start,
+            'stop': self.handle_stop,
+            'word': self.handle_word,
+            'words': self.handle_words,
+            'getUpdate': self.handle_get_update,
+        }
 
     def make_init(self):
         # we must make a new copy of this each time
@@ -395,6 +732,9 @@ class BoggleGameState:
             'seed': None,
             'level': None,
             'words': None,
+            # set of the words in words; not persisted, see to_durable
+            'found': None,
+            'score': None, # total score of words
             'round_trophies': 0, # bitmask
             'trophies': 0, # bitmask
             'stats': BoggleStats(),
@@ -443,27 +783,26 @@ class BoggleGameState:
         return True
 
     def stop_game(self, game_data):
-        # found_special = game_get_found_special(game_data)
-        all_words = [
-            w for w in get_game_spec(game_data).wordlist
-            # if found_special or w[0] != get_game_spec(game_data).special
-        ]
-
-        game_data['stats'].update_stats(game_data)
+        # what may fail is done before game_data is changed
+        game_spec = get_game_spec(game_data)
         max_score = game_get_max_score(game_data)
         hiscore = int(game_get_score(game_data) / max_score * HISCORE_SCALE)
         self.set_hiscore(game_data['level'], hiscore)
+
+        game_data['stats'].update_stats(game_data)
         discard_game_spec_from_cache(game_data)
         game_data['running'] = False
         game_data['start_time'] = None
         game_data['seed'] = None
         game_data['level'] = None
         game_data['words'] = None
+        game_data['found'] = None
+        game_data['score'] = None
         game_data['round_trophies'] = 0
 
         save_data(self.team, game_data)
 
-        return self.make_full_update(game_data, True, all_words=all_words)
+        return self.make_full_update(game_data, True, ended_spec=game_spec)
 
     def get_trophy_string(self, game_data):
         res = ''
@@ -483,7 +822,9 @@ class BoggleGameState:
             'grade': grade,
         })]
 
-    def make_full_update(self, game_data, broadcast=False, all_words=None):
+    # ended_spec is the spec of a round that just ended, whose words are
+    # sent along
+    def make_full_update(self, game_data, broadcast=False, ended_spec=None):
         is_running = game_data['running']
         max_level = game_data['max_level']
         msg = {
@@ -499,6 +840,7 @@ class BoggleGameState:
         if max_level >= 4:
             msg['blanks'] = '_ _ _ _ _ _ _ _ _ _   _ _ _ _ _ _'
 
+        fragments = []
         if is_running:
             words = game_data['words']
 
@@ -507,10 +849,8 @@ class BoggleGameState:
             msg['totTime'] = self.get_cl_tot_time(game_data)
             msg['words'] = words
             msg['score'] = game_get_score(game_data)
-            msg['grid'] = get_game_spec(game_data).grid
-            msg['bonuses'] = [[k, v] for k, v in get_game_spec(game_data).bonuses.items()]
-            msg['totNumWords'] = game_get_max_num_words(game_data)
-            msg['maxScore'] = game_get_max_score(game_data)
+            # grid, bonuses, totNumWords and maxScore
+            fragments += get_game_spec(game_data).get_static_fragments()
             msg['debugSeed'] = game_data['seed']
 
             # special = game_get_special(game_data)
@@ -518,10 +858,44 @@ class BoggleGameState:
             # if found_special:
             #     msg['special'] = special
 
-        if all_words is not None:
-            msg['allWords'] = all_words
+        if ended_spec is not None:
+            fragments.append(ended_spec.get_all_words_fragment())
+
+        return [BoggleAction(broadcast, msg, fragments)]
 
-        return [BoggleAction(broadcast, msg)]
+    # Sent to the team when words are found, with just the new words, the
+    # new score and whatever else changed, to clients that accept deltas
+    # of DELTA_VERSION; the others are sent a full update instead. One new
+    # word is sent as word, several (from a words message) as newWords.
+    # numWords counts the words found so far this game: a client that has
+    # numWords minus the new words (for the same numGames) can apply it,
+    # any other client missed an update and should send getUpdate for a
+    # full one.
+    def make_word_update(self, game_data, old_game_data, num_new=1):
+        msg = {
+            'type': 'delta',
+            'version': DELTA_VERSION,
+            'numGames': game_data['num_games'],
+            'numWords': len(game_data['words']),
+            'score': game_get_score(game_data),
+        }
+        if num_new == 1:
+            msg['word'] = game_data['words'][-1]
+        else:
+            msg['newWords'] = game_data['words'][-num_new:]
+        if game_data['round_trophies'] != old_game_data['round_trophies']:
+            msg['roundTrophies'] = game_data['round_trophies']
+        if game_data['trophies'] != old_game_data['trophies']:
+            msg['trophies'] = self.get_trophy_string(game_data)
+        if game_data['max_level'] != old_game_data['max_level']:
+            msg['maxLevel'] = game_data['max_level']
+            if game_data['max_level'] >= 4:
+                msg['blanks'] = '_ _ _ _ _ _ _ _ _ _   _ _ _ _ _ _'
+
+        full_update = self.make_full_update(game_data, True)
+        for action in full_update:
+            action.deltas = False
+        return [BoggleAction(True, msg, deltas=True)] + full_update
 
     def handle_start(self, game_data, msg):
         if not V.has_key(msg, 'level') or not V.is_nat(msg['level'], 4):
@@ -533,12 +907,16 @@ class BoggleGameState:
         if level > game_data['max_level']:
             return None, self.make_full_update(game_data)
 
+        # before game_data is changed, in case it fails
+        seed = draw_game_seed(level)
         game_data['num_games'] += 1
         game_data['running'] = True
         game_data['start_time'] = datetime.datetime.timestamp(datetime.datetime.now())
-        game_data['seed'] = random.SystemRandom().randrange(1<<28)
+        game_data['seed'] = seed
         game_data['level'] = level
         game_data['words'] = []
+        game_data['found'] = set()
+        game_data['score'] = 0
         game_data['round_trophies'] = 0
         # print(game_data['seed'])
         return game_data, self.make_full_update(game_data, True)
@@ -555,11 +933,12 @@ class BoggleGameState:
     def get_round_trophies(self, game_data):
         level = game_data['level']
         trophies_per_level = len(GETS_TROPHY_FUNCS)
+        game_spec = get_game_spec(game_data)
 
         trophies = 0
         for i in range(trophies_per_level):
             trophy_index = level * trophies_per_level + i
-            if gets_trophy(game_data, i):
+            if gets_trophy(game_spec, game_data, i):
                 trophies |= 1 << trophy_index
         return trophies
 
@@ -578,15 +957,66 @@ class BoggleGameState:
             return game_data, actions
 
         game_spec = get_game_spec(game_data)
-        entries = [w for w in game_spec.wordlist if w[0] == word]
-        if len(entries) == 0:
-            return None, self.make_grade(word, GRADE_WRONG)
-        entry = entries[0]
-        if len([w for w in game_data['words'] if w[0] == entry[0]]) > 0:
-            return None, self.make_grade(word, GRADE_DUPLICATE)
+        old_game_data = {
+            k: game_data[k] for k in ('max_level', 'trophies', 'round_trophies')
+        }
+        grade = self.add_word(game_data, game_spec, word)
+        if grade != GRADE_CORRECT:
+            return None, self.make_grade(word, grade)
+        self.update_trophies(game_data)
+
+        return game_data, self.make_grade(word, GRADE_CORRECT) + self.make_word_update(game_data, old_game_data)
 
-        game_data['words'] += [[entry[0], entry[1]]]
+    # like word, for a list of words; answered with a grades message
+    # holding the grade of each word, and at most one delta
+    def handle_words(self, game_data, msg):
+        if not V.has_key(msg, 'words') or not V.is_list(msg['words'], MAX_WORDS_PER_MESSAGE):
+            return None, []
+        words = msg['words']
+        if not all(V.is_str(word) for word in words):
+            return None, []
 
+        if not game_data['running']:
+            return None, self.make_full_update(game_data)
+        if not self.cl_num_games_valid(game_data, msg):
+            return None, self.make_full_update(game_data)
+
+        if self.get_time_left(game_data) < datetime.timedelta():
+            actions = self.stop_game(game_data)
+            return game_data, actions
+
+        game_spec = get_game_spec(game_data)
+        old_game_data = {
+            k: game_data[k] for k in ('max_level', 'trophies', 'round_trophies')
+        }
+        old_num_words = len(game_data['words'])
+        grades = [self.add_word(game_data, game_spec, word) for word in words]
+        actions = [BoggleAction.make_respond({
+            'type': 'grades',
+            'grades': grades,
+        })]
+        num_new = len(game_data['words']) - old_num_words
+        if num_new == 0:
+            return None, actions
+        # trophies only depend on the words found, so checking them once
+        # after all words is the same as after each one
+        self.update_trophies(game_data)
+
+        return game_data, actions + self.make_word_update(game_data, old_game_data, num_new)
+
+    # grades word, adding it to the words found if it's correct
+    def add_word(self, game_data, game_spec, word):
+        score = game_spec.word_scores.get(word)
+        if score is None:
+            return GRADE_WRONG
+        if word in game_data['found']:
+            return GRADE_DUPLICATE
+        game_data['words'] += [[word, score]]
+        game_data['found'].add(word)
+        game_data['score'] += score
+        return GRADE_CORRECT
+
+    def update_trophies(self, game_data):
         round_trophies = self.get_round_trophies(game_data)
         new_trophies = round_trophies & (~game_data['trophies'])
         game_data['trophies'] |= round_trophies
@@ -602,9 +1032,6 @@ class BoggleGameState:
                 4
             )
 
-        # TODO: only need to send things that changed
-        return game_data, self.make_grade(word, GRADE_CORRECT) + self.make_full_update(game_data, True)
-
     # used to get full updates, e.g. on join
     def handle_get_update(self, game_data, msg):
         return game_data, self.make_full_update(game_data)
@@ -612,19 +1039,36 @@ class BoggleGameState:
     def set_hiscore(self, level, score):
         set_hiscore(self.team, level, score)
 
-    def get_hiscores(self, level):
-        return get_hiscores_check(self.team, level)
-
     def handle_get_hiscores(self, msg):
         if not V.has_key(msg, 'level') or not V.is_nat(msg['level'], 4):
             return []
-        hiscores = self.get_hiscores(msg['level'])
-        return [BoggleAction.make_respond({
+        # the encoded list is shared by all requests until it changes
+        hiscores = get_leaderboard(msg['level']).get_json()
+        return [BoggleAction(False, {
             'type': 'hiscores',
-            'hiscores': hiscores,
-        })]
+        }, [('hiscores', hiscores)])]
+
+    # whether handling msg may block on the database or on solving a
+    # board: if the round's spec isn't cached, a word stops a round that is
+    # over (saving its hiscore), or a leaderboard has to be loaded
+    def may_block(self, game_data, msg):
+        if not isinstance(msg, dict):
+            return False
+        msg_type = msg.get('type')
+        if msg_type == 'getHiscores':
+            level = msg.get('level')
+            return level in range(4) and not is_leaderboard_loaded(level)
+        if not game_data['running']:
+            return False
+        if (game_data['level'], game_data['seed']) not in game_spec_cache:
+            return True
+        if msg_type in ('word', 'words'):
+            return self.get_time_left(game_data) < datetime.timedelta()
+        return False
 
+    # sets new_game_data to the new state if msg changed it, or to None
     def handle(self, game_data, msg):
+        self.new_game_data = None
         # this should be all the validation that is performed
         # before update_pings is called
         if not V.is_dict(msg) or not V.has_key(msg, 'type'):
@@ -636,17 +1080,12 @@ class BoggleGameState:
         if msg_type == 'AUTH':
             return
 
-        reducers = {
-            'start': self.handle_start,
-            'stop': self.handle_stop,
-            'word': self.handle_word,
-            'getUpdate': self.handle_get_update,
-        }
-
         actions = []
-        if msg_type in reducers:
-            actions += self.handle_txn(game_data, reducers[msg_type], msg)
+        if msg_type in self.reducers:
+            with handle_seconds.time(msg_type):
+                actions += self.handle_txn(game_data, self.reducers[msg_type], msg)
         if msg_type == 'getHiscores':
-            actions += self.handle_get_hiscores(msg)
+            with handle_seconds.time(msg_type):
+                actions += self.handle_get_hiscores(msg)
 
         return actions
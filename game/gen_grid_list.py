@@ -1,99 +1,119 @@
 import pathlib
+import zlib
 from .gen_grid import _CARROLLWORDS
+from .topology import get_topology
+from .lexicon import Lexicon, cell_codes, DEAD, ROW_SIZE, TERMINAL
+from .metrics import Histogram
 
-words = None
-prefixes = None
+lexicon = None
 
 def sanitize(word):
     return ''.join([c for c in word.lower() if c.isalpha()])
 
-def gen_words_and_prefixes():
-    global words, prefixes
-
-    dataDir = pathlib.Path(__file__).parent.resolve() / 'data'
-    # feel free to experiment with this
-    dictDir = dataDir/"dict/3of6game.txt"
+dataDir = pathlib.Path(__file__).parent.resolve() / 'data'
+# feel free to experiment with this
+dictDir = dataDir/"dict/3of6game.txt"
+# prebuilt by `python -m game.build_lexicon`
+lexiconPath = dataDir/"dict/3of6game.lex"
 
+def read_words():
     all_words_l = [word for word in open(str(dictDir))]
     all_words_l += _CARROLLWORDS
     words = set(sanitize(word).rstrip('\n') for word in all_words_l if len(word) >= 4) # 4 because all words have trailing \n
-    prefixes = set(word[:i] for word in words
-                    for i in range(2, len(word)+1))
+    return sorted(words)
+
+def gen_lexicon():
+    global lexicon
+
+    lexicon = Lexicon.load(str(lexiconPath))
+    if lexicon is None:
+        # no (compatible) prebuilt file, so build it in memory
+        lexicon = Lexicon.from_words(read_words())
+
+# identifies the lexicon contents, e.g. to tell whether stored specs are
+# stale
+def lexicon_fingerprint():
+    if lexicon is None:
+        gen_lexicon()
+    return '%08x' % (zlib.crc32(lexicon.table),)
 
 def _solve_init(board, level):
     # print(board, level)
     # Return generator of words found
 
-    if words is None:
-        gen_words_and_prefixes()
+    if lexicon is None:
+        gen_lexicon()
+    table = lexicon.table
+    root = lexicon.root
+    neighbors = get_topology(level).neighbor_cells
+
+    # walk the lexicon from node through the letters of a cell
+    def step(node, codes):
+        for code in codes:
+            node = table[node * ROW_SIZE + code]
+        return node
 
     def solve():
         if level != 3:
+            codes = [[cell_codes(letter) for letter in row] for row in board]
             for y, row in enumerate(board):
                 for x, letter in enumerate(row):
-                    for result in extending(letter, ((x, y),)):
-                        yield result
+                    if codes[y][x] is None:
+                        continue
+                    node = step(root, codes[y][x])
+                    if node != DEAD:
+                        for result in extending(codes, node, ((x, y),)):
+                            yield result
         
         else:
+            codes = [[[cell_codes(letter) for letter in row] for row in plane] for plane in board]
             for z, plane in enumerate(board):
                 for y, row in enumerate(plane):
                     for x, letter in enumerate(row):
-                        for result in extending3(letter, ((x, y, z),)):
-                            yield result
+                        if codes[z][y][x] is None:
+                            continue
+                        node = step(root, codes[z][y][x])
+                        if node != DEAD:
+                            for result in extending3(codes, node, ((x, y, z),)):
+                                yield result
 
-    def extending(prefix, path):
-        if prefix in words:
-            yield (prefix, path)
-        for (nx, ny) in neighbors(path[-1][0], path[-1][1]):
-            if (nx, ny) not in path:
-                prefix1 = prefix + board[ny][nx]
-                if prefix1 in prefixes:
-                    for result in extending(prefix1, path + ((nx, ny),)):
+    # node is the lexicon node reached by spelling out path; the word
+    # itself is only assembled once we hit a terminal node
+    def extending(codes, node, path):
+        if table[node * ROW_SIZE + TERMINAL]:
+            yield (''.join(board[y][x] for x, y in path), path)
+        for (nx, ny) in neighbors[path[-1]]:
+            if (nx, ny) not in path and codes[ny][nx] is not None:
+                node1 = node
+                for code in codes[ny][nx]:
+                    node1 = table[node1 * ROW_SIZE + code]
+                if node1 != DEAD:
+                    for result in extending(codes, node1, path + ((nx, ny),)):
                         yield result
     
-    def extending3(prefix, path):
-        if prefix in words:
-            yield (prefix, path)
-        for (nx, ny, nz) in neighbors(path[-1][0], path[-1][1], path[-1][2]):
-            if (nx, ny, nz) not in path:
-                prefix1 = prefix + board[nz][ny][nx]
-                if prefix1 in prefixes:
-                    for result in extending3(prefix1, path + ((nx, ny, nz),)):
+    def extending3(codes, node, path):
+        if table[node * ROW_SIZE + TERMINAL]:
+            yield (''.join(board[z][y][x] for x, y, z in path), path)
+        for (nx, ny, nz) in neighbors[path[-1]]:
+            if (nx, ny, nz) not in path and codes[nz][ny][nx] is not None:
+                node1 = node
+                for code in codes[nz][ny][nx]:
+                    node1 = table[node1 * ROW_SIZE + code]
+                if node1 != DEAD:
+                    for result in extending3(codes, node1, path + ((nx, ny, nz),)):
                         yield result
 
-    def neighbors(x, y, z=0):
-        if level == 0: #standard adjacency
-            for nx in range(max(0, x-1), min(x+2, 6)):
-                for ny in range(max(0, y-1), min(y+2, 6)):
-                    yield (nx, ny)
-        elif level == 1: #hex adjacency
-            for nx in range(max(0, x-1), min(x+2, 5)):
-                for ny in range(max(0, y-1), min(y+2, 5)):
-                    if (nx-x) != (ny-y):
-                        yield (nx, ny)
-        elif level == 2: #knight adjacency
-            d = ((1,2),(2,1),(-1,2),(-2,1),(-1,-2),(-2,-1),(1,-2),(2,-1))
-            for dd in d:
-                if 0 <= dd[0] + x <= 5 and 0 <= dd[1] + y <= 5:
-                    yield (dd[0]+x,dd[1]+y)
-        elif level == 3: #3d adjacency
-            d = ((0,0,1),(0,1,0),(1,0,0),(0,0,-1),(0,-1,0),(-1,0,0))
-            for dd in d:
-                if 0 <= dd[0]+x <= 2 and 0 <= dd[1]+y <= 2 and 0 <= dd[2]+z <= 2:
-                    yield (dd[0]+x,dd[1]+y,dd[2]+z)
-    
     return solve()
 
-def _get_score_dict(board, level, bonus, cword=""):
+def score_word(word):
+    x = len(word)
+    if x <= 6:
+        return (x-2)*(x-3)*5+10
+    else:
+        return x*40-170
+
+def _get_score_dict_recursive(board, level, bonus):
     valid_words = {}
-    def score_word(x):
-        #if x == cword:
-        #    return 250
-        x = len(x)
-        if x <= 6:
-            return (x-2)*(x-3)*5+10
-        else:
-            return x*40-170
 
     for i in _solve_init(board, level):
         score = score_word(i[0])
@@ -108,6 +128,75 @@ def _get_score_dict(board, level, bonus, cword=""):
     
     return valid_words
 
+# Same results (including dict order) as _get_score_dict_recursive, but
+# runs the DFS on an explicit stack with a bitmask of visited cells and
+# keeps the best score for each word as it goes.
+def _get_score_dict_bitmask(board, level, bonus):
+    if lexicon is None:
+        gen_lexicon()
+    table = lexicon.table
+    root = lexicon.root
+
+    topology = get_topology(level)
+    cells = topology.cells
+    letters = topology.flatten(board)
+    codes = [cell_codes(letter) for letter in letters]
+    mults = [bonus.get(cell, 1) for cell in cells]
+    # reversed so that popping the stack visits neighbors in order
+    rev_neighbors = [
+        tuple(n for n in reversed(ns) if codes[n] is not None)
+        for ns in topology.neighbors
+    ]
+
+    valid_words = {}
+    path = [0] * len(cells)
+    for start in range(len(cells)):
+        if codes[start] is None:
+            continue
+        node = root
+        for code in codes[start]:
+            node = table[node * ROW_SIZE + code]
+        if node == DEAD:
+            continue
+
+        # (cell, lexicon node, depth, visited mask, bonus multiplier)
+        stack = [(start, node, 0, 1 << start, mults[start])]
+        while stack:
+            cell, node, depth, mask, mult = stack.pop()
+            path[depth] = cell
+            if table[node * ROW_SIZE + TERMINAL]:
+                word = ''.join([letters[c] for c in path[:depth + 1]])
+                score = score_word(word) * mult
+                if score > valid_words.get(word, -1):
+                    valid_words[word] = score
+            for n in rev_neighbors[cell]:
+                if mask >> n & 1:
+                    continue
+                node1 = node
+                for code in codes[n]:
+                    node1 = table[node1 * ROW_SIZE + code]
+                if node1 != DEAD:
+                    stack.append((
+                        n, node1, depth + 1, mask | (1 << n), mult * mults[n]
+                    ))
+
+    return valid_words
+
+SOLVER_ENGINES = {
+    'recursive': _get_score_dict_recursive,
+    'bitmask': _get_score_dict_bitmask,
+}
+SOLVER_ENGINE = 'bitmask'
+
+solve_seconds = Histogram(
+    'boggle_solve_seconds', 'Time taken by _get_score_dict', ['level', 'engine']
+)
+
+def _get_score_dict(board, level, bonus, cword="", engine=None):
+    engine = engine or SOLVER_ENGINE
+    with solve_seconds.time(level, engine):
+        return SOLVER_ENGINES[engine](board, level, bonus)
+
 def test():
     level = 0
     board = [["#", "#", "a", "b", "#", "#"],["#", "c", "d", "e", "f", "#"],["g", "h", "i", "j", "k", "l"],["m", "n", "r", "p", "qu", "r"],["#", "s", "t", "u", "v", "#"],["#", "#", "w", "x", "#", "#"]]
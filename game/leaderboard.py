@@ -0,0 +1,50 @@
+import bisect
+import itertools
+import json
+import threading
+
+# The best scores of one level, best first, kept in memory so hiscore
+# requests don't touch the database. Only the size best teams are kept,
+# as the database is compacted to the same size (see compact_db).
+#
+# Teams with equal scores are ranked by who got there first. The encoded
+# list is cached until the next change.
+class Leaderboard:
+    def __init__(self, size, entries=()):
+        self.size = size
+        self.lock = threading.Lock()
+        # team -> (-score, order, team), the entry's key in ranked
+        self.keys = {}
+        self.ranked = []
+        self.order = itertools.count()
+        self.json = None
+        for team, score in entries:
+            self.update(team, score)
+
+    # records score for team if it is an improvement, and returns whether
+    # it was (and the team is on the board)
+    def update(self, team, score):
+        with self.lock:
+            old_key = self.keys.get(team)
+            if old_key is not None:
+                if score <= -old_key[0]:
+                    return False
+                del self.ranked[bisect.bisect_left(self.ranked, old_key)]
+            key = (-score, next(self.order), team)
+            self.keys[team] = key
+            bisect.insort(self.ranked, key)
+            while len(self.ranked) > self.size:
+                del self.keys[self.ranked.pop()[2]]
+            if team not in self.keys:
+                return False
+            self.json = None
+            return True
+
+    # the encoded list of [team, score]
+    def get_json(self):
+        with self.lock:
+            if self.json is None:
+                self.json = json.dumps([
+                    [team, -neg_score] for neg_score, order, team in self.ranked
+                ])
+            return self.json
@@ -0,0 +1,132 @@
+import mmap
+import os
+import string
+import struct
+import sys
+from array import array
+
+# each node is a row of ROW_SIZE unsigned ints: one child pointer per
+# letter a-z followed by the terminal flag
+ALPHABET_SIZE = 26
+TERMINAL = ALPHABET_SIZE
+ROW_SIZE = ALPHABET_SIZE + 1
+
+# node 0 is a dead sink (no children, not terminal), so a child pointer
+# of 0 means "no such prefix" and stepping out of it stays dead
+DEAD = 0
+
+# binary format: header, then the table as uint32 rows in the byte order of
+# the machine that wrote it, which the header records so other machines
+# don't map it
+FILE_MAGIC = b'BGLX'
+FILE_VERSION = 2
+# magic, version, num_nodes, root, whether the table is big-endian
+FILE_HEADER = struct.Struct('<4sIIII')
+BIG_ENDIAN = int(sys.byteorder == 'big')
+
+LETTER_CODES = {c: i for i, c in enumerate(string.ascii_lowercase)}
+
+# codes for each letter of a board cell (e.g. 'qu' -> (16, 20)), or None
+# for cells that can never be part of a word (e.g. '#')
+def cell_codes(letters):
+    codes = tuple(LETTER_CODES.get(c) for c in letters)
+    if len(codes) == 0 or None in codes:
+        return None
+    return codes
+
+class Lexicon:
+    # a DAWG (trie with identical suffix subtrees merged) stored as a flat
+    # table of rows; children always have smaller ids than their parents
+    def __init__(self, table, root):
+        self.table = table
+        self.root = root
+        self.num_nodes = len(table) // ROW_SIZE
+
+    @staticmethod
+    def from_words(words):
+        trie = {}
+        for word in words:
+            if cell_codes(word) is None:
+                # can never be spelled on a board
+                continue
+            node = trie
+            for c in word:
+                node = node.setdefault(c, {})
+            node[''] = True
+
+        table = array('I', [0] * ROW_SIZE)
+        registry = {tuple(table): DEAD}
+
+        def freeze(trie_node):
+            row = [0] * ROW_SIZE
+            for c, child in trie_node.items():
+                if c == '':
+                    row[TERMINAL] = 1
+                else:
+                    row[LETTER_CODES[c]] = freeze(child)
+            key = tuple(row)
+            node = registry.get(key)
+            if node is None:
+                node = len(table) // ROW_SIZE
+                registry[key] = node
+                table.extend(row)
+            return node
+
+        root = freeze(trie)
+        return Lexicon(table, root)
+
+    # follow a board cell (e.g. 'a' or 'qu') from node; returns DEAD if
+    # no word continues that way
+    def step(self, node, letters):
+        table = self.table
+        for c in letters:
+            code = LETTER_CODES.get(c)
+            if code is None:
+                return DEAD
+            node = table[node * ROW_SIZE + code]
+            if node == DEAD:
+                return DEAD
+        return node
+
+    def is_terminal(self, node):
+        return self.table[node * ROW_SIZE + TERMINAL] != 0
+
+    def __contains__(self, word):
+        node = self.step(self.root, word)
+        return node != DEAD and self.is_terminal(node)
+
+    # write the table to path so it can be mapped by load()
+    def save(self, path):
+        tmp_path = '%s.tmp' % (path,)
+        with open(tmp_path, 'wb') as f:
+            f.write(FILE_HEADER.pack(
+                FILE_MAGIC, FILE_VERSION, self.num_nodes, self.root, BIG_ENDIAN
+            ))
+            f.write(array('I', self.table).tobytes())
+        os.replace(tmp_path, path)
+
+    # map a file written by save(); pages are shared between every process
+    # that loads the same file. Returns None if the file is missing or was
+    # written by an incompatible version or on a machine of another byte
+    # order.
+    @staticmethod
+    def load(path):
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        with f:
+            header = f.read(FILE_HEADER.size)
+            if len(header) < FILE_HEADER.size:
+                return None
+            magic, version, num_nodes, root, big_endian = FILE_HEADER.unpack(header)
+            if magic != FILE_MAGIC or version != FILE_VERSION:
+                return None
+            if big_endian != BIG_ENDIAN:
+                return None
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        table_size = num_nodes * ROW_SIZE * array('I').itemsize
+        if len(mm) != FILE_HEADER.size + table_size:
+            mm.close()
+            return None
+        return Lexicon(memoryview(mm)[FILE_HEADER.size:].cast('I'), root)
@@ -0,0 +1,159 @@
+import contextlib
+import http.server
+import threading
+import time
+
+# Counters, gauges and latency histograms, rendered in the Prometheus text
+# format by render() and served by start_http_server. Metrics register
+# themselves when created; label values are passed positionally, in the
+# order of the metric's label names.
+#
+# Only what happens in this process is recorded; e.g. specs generated by
+# a process pool aren't.
+
+# seconds
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+
+registry = []
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if len(pairs) == 0:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, escape(value)) for name, value in pairs)
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def render_header(self):
+        return [
+            '# HELP %s %s' % (self.name, self.help),
+            '# TYPE %s %s' % (self.name, self.type),
+        ]
+
+# A value per label values, either kept here or computed by func when
+# rendered: func returns the value, or with labels a dict of label values
+# tuple -> value.
+class Value(Metric):
+    def __init__(self, name, help, labels=(), func=None):
+        super().__init__(name, help, labels)
+        self.func = func
+        self.values = {}
+
+    def render(self):
+        if self.func is None:
+            with self.lock:
+                values = list(self.values.items())
+            # an unlabelled metric has its sample before it is first set
+            if len(self.labels) == 0 and len(values) == 0:
+                values = [((), 0)]
+        elif len(self.labels) == 0:
+            values = [((), self.func())]
+        else:
+            values = list(self.func().items())
+        return self.render_header() + [
+            '%s%s %s' % (self.name, format_labels(self.labels, k), format_value(v))
+            for k, v in values
+        ]
+
+class Counter(Value):
+    type = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+class Gauge(Value):
+    type = 'gauge'
+
+    def set(self, value, *label_values):
+        with self.lock:
+            self.values[label_values] = value
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        # label values -> [bucket counts, sum, count]
+        self.values = {}
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            if label_values not in self.values:
+                self.values[label_values] = [[0] * len(self.buckets), 0, 0]
+            entry = self.values[label_values]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    # observes the time the with block takes
+    @contextlib.contextmanager
+    def time(self, *label_values):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def render(self):
+        with self.lock:
+            values = [(k, list(v[0]), v[1], v[2]) for k, v in self.values.items()]
+        if len(self.labels) == 0 and len(values) == 0:
+            values = [((), [0] * len(self.buckets), 0, 0)]
+        lines = self.render_header()
+        for k, counts, total, count in values:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append('%s_bucket%s %d' % (
+                    self.name,
+                    format_labels(self.labels, k, [('le', format_value(bound))]),
+                    cumulative
+                ))
+            lines.append('%s_sum%s %s' % (self.name, format_labels(self.labels, k), format_value(total)))
+            lines.append('%s_count%s %d' % (self.name, format_labels(self.labels, k), count))
+        return lines
+
+def render():
+    lines = []
+    for metric in list(registry):
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+# serves render() on every path, from a background thread
+def start_http_server(port, host='localhost'):
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -18,3 +18,4 @@ class BoggleHighScoreData(models.Model):
 
     class Meta:
         unique_together = ('team', 'level')
+        indexes = [models.Index(fields=['level', 'score'])]
@@ -1,13 +1,17 @@
 import json
 import datetime
+import pathlib
 import random
 
 from asgiref.sync import async_to_sync
+from django.core.cache import cache
 
 from hunt.teamwork import TeamworkTimeConsumer
 from .validate import Validator as V
 from .gen_grid_list import _get_score_dict
-from .gen_grid import gen_grid
+from .spec_gen import gen_spec, open_spec_store, store_spec, load_spec
+from .spec_pool import GameSpecPool
+from .spec_cache import GameSpecCache
 
 from .models import *
 
@@ -82,6 +86,15 @@ class BoggleGameSpec:
         self.bonuses = bonuses
         self.wordlist = wordlist
         self.special = special
+        # word -> score, for grading
+        self.word_scores = dict(wordlist)
+        self.max_score = sum(score for word, score in wordlist)
+        self.num_words = len(wordlist)
+        # what each trophy's progress is compared with, see gets_trophy
+        self.trophy_targets = get_trophy_targets(self)
+        # members of a full update that only depend on the spec, built when
+        # first needed; see get_static_fields
+        self.static_fields = None
 
     @staticmethod
     def get_testing_spec(level):
@@ -98,73 +111,87 @@ class BoggleGameSpec:
             wordlist[0][0]
         )
 
+    # the channel layer encodes messages itself, so unlike the posthunt
+    # server these can't be kept encoded, only kept from being rebuilt
+    def get_static_fields(self):
+        if self.static_fields is None:
+            self.static_fields = {
+                'grid': self.grid,
+                'bonuses': [[k, v] for k, v in self.bonuses.items()],
+                'totNumWords': self.num_words,
+                'maxScore': self.max_score,
+            }
+        return self.static_fields
+
 DATABASE_VERSION = 4
 ANSWER = 'NOHTDORUWEAARLDN'
 HISCORE_SCALE = 100000
+HISCORES_CACHE_KEY = 'boggle_hiscores_%d'
+# leaderboards are dropped from the cache whenever they change; this only
+# bounds how long one read just before a change can stay cached
+HISCORES_CACHE_TIMEOUT = 60
 
 # TODO: make sure this is eventually 100
 CACHE_SIZE = 100
-game_spec_cache = {}
+# seconds a spec that isn't pinned may go unused before it is dropped
+CACHE_TTL = None
+# how long past its time limit a running game's spec stays pinned
+CACHE_PIN_GRACE = datetime.timedelta(minutes=1)
 
 def gen_game_spec(level, seed):
-    cutoff = 105
-    invalid_grid = True
-    rand_obj = random.Random(seed)
+    return BoggleGameSpec(level, *gen_spec(level, seed))
 
-    gen_level = [0, 1, 3, 2][level]
-    while invalid_grid:
-        grid, bonuses, special = gen_grid(gen_level, rand_obj)
-        wordlist = [
-            (word, score) for word, score in
-            _get_score_dict(grid, gen_level, bonuses).items()
-        ]
-        if len(wordlist) >= cutoff:
-            invalid_grid = False
-        else:
-            cutoff -= 5
+# specs solved by any process on this host are kept here; None to disable
+SPEC_STORE_PATH = str(pathlib.Path(__file__).parent.resolve() / 'db' / 'specs.sqlite')
+game_spec_store = open_spec_store(SPEC_STORE_PATH)
 
-    return BoggleGameSpec(
-        level, grid, bonuses, wordlist, special
-    )
+def store_game_spec(seed, game_spec):
+    store_spec(game_spec_store, game_spec.level, seed, (
+        game_spec.grid, game_spec.bonuses, game_spec.wordlist, game_spec.special
+    ))
 
-def discard_game_spec_from_cache(game_data):
-    global game_spec_cache
+# reuses a spec solved before (maybe by another process) if possible
+def load_game_spec(level, seed):
+    return BoggleGameSpec(level, *load_spec(game_spec_store, level, seed))
+
+game_spec_cache = GameSpecCache(load_game_spec, CACHE_SIZE, CACHE_TTL)
 
+def discard_game_spec_from_cache(game_data):
     level = game_data['level']
     seed = game_data['seed']
     key = (level, seed)
-    game_spec_cache.pop(key, None)
+    game_spec_cache.discard(key)
 
 def get_game_spec(game_data):
-    global game_spec_cache
-
     level = game_data['level']
     seed = game_data['seed']
     key = (level, seed)
-    if key in game_spec_cache:
-        game_spec_cache[key] = (
-            datetime.datetime.now(),
-            game_spec_cache[key][1]
-        )
-    else:
-        if len(game_spec_cache) >= CACHE_SIZE:
-            game_spec_cache = {
-                k: v for k, v in
-                sorted([
-                    (k, v) for k, v in game_spec_cache.items()
-                ], key=lambda k: k[0], reverse=True)[:CACHE_SIZE//2]
-            }
-        game_spec_cache[key] = (
-            datetime.datetime.now(),
-            gen_game_spec(level, seed)
-        )
-    return game_spec_cache[key][1]
+    pin_until = None
+    if game_data['running']:
+        # keep it until the round is over
+        time_limit = TIME_LIMITS_PER_LEVEL[level] + CACHE_PIN_GRACE
+        pin_until = game_data['start_time'] + time_limit.total_seconds()
+    return game_spec_cache.get(key, pin_until)
+
+# number of ready specs kept per level by game_spec_pool
+SPEC_POOL_SIZE = 4
+game_spec_pool = GameSpecPool(gen_game_spec, range(4), SPEC_POOL_SIZE)
+
+# picks the seed for a new round, preferring one whose spec is ready
+def draw_game_seed(level):
+    entry = game_spec_pool.pop(level)
+    if entry is None:
+        return random.SystemRandom().randrange(1<<28)
+    seed, game_spec = entry
+    game_spec_cache.put((level, seed), game_spec)
+    store_game_spec(seed, game_spec)
+    return seed
 
 def get_total_score(game_spec, words):
     return sum([w[1] for w in words])
 
 def get_max_score(game_spec):
-    return sum([w[1] for w in game_spec.wordlist])
+    return game_spec.max_score
 
 # TODO: make sure these are reasonable numbers
 TROPHY_THRESHOLDS = [
@@ -174,13 +201,17 @@ TROPHY_THRESHOLDS = [
     [20, 35],
 ]
 
-def gets_trophy_num(game_spec, words, threshold):
-    return len(words) >= len(game_spec.wordlist) * threshold
+def trophy_target_num(game_spec, threshold):
+    return game_spec.num_words * threshold
 
-def gets_trophy_points(game_spec, words, threshold):
-    score = get_total_score(game_spec, words)
-    max_score = get_max_score(game_spec)
-    return score >= max_score * threshold
+def trophy_target_points(game_spec, threshold):
+    return game_spec.max_score * threshold
+
+def gets_trophy_num(game_data, target):
+    return len(game_data['words']) >= target
+
+def gets_trophy_points(game_data, target):
+    return game_data['score'] >= target
 
 # def gets_trophy_longest(game_spec, words):
 #     max_len = max(len(w[0]) for w in words)
@@ -197,26 +228,42 @@ GETS_TROPHY_FUNCS = [
     gets_trophy_points,
 ]
 
-def gets_trophy(game_data, index):
-    game_spec = get_game_spec(game_data)
-    level = game_spec.level
-    words = game_data['words']
-    threshold = TROPHY_THRESHOLDS[level][index // 2] / 100
-    return GETS_TROPHY_FUNCS[index](game_spec, words, threshold)
+TROPHY_TARGET_FUNCS = [
+    trophy_target_num,
+    trophy_target_points,
+    trophy_target_num,
+    trophy_target_points,
+]
+
+def get_trophy_targets(game_spec):
+    return [
+        TROPHY_TARGET_FUNCS[index](
+            game_spec,
+            TROPHY_THRESHOLDS[game_spec.level][index // 2] / 100
+        )
+        for index in range(len(TROPHY_TARGET_FUNCS))
+    ]
+
+def gets_trophy(game_spec, game_data, index):
+    target = game_spec.trophy_targets[index]
+    return GETS_TROPHY_FUNCS[index](game_data, target)
 
 # response codes to client words
 GRADE_WRONG = 0
 GRADE_DUPLICATE = 1
 GRADE_CORRECT = 2
+# most words a words message may carry
+MAX_WORDS_PER_MESSAGE = 100
 
 def game_get_max_score(game_data):
     return get_max_score(get_game_spec(game_data))
 
+# kept up to date as words are found
 def game_get_score(game_data):
-    return get_total_score(get_game_spec(game_data), game_data['words'])
+    return game_data['score']
 
 def game_get_max_num_words(game_data):
-    return len(get_game_spec(game_data).wordlist)
+    return get_game_spec(game_data).num_words
 
 def game_get_num_words(game_data):
     return len(game_data['words'])
@@ -226,7 +273,31 @@ def game_get_special(game_data):
 
 def game_get_found_special(game_data):
     special = game_get_special(game_data)
-    return len([w for w in game_data['words'] if w[0] == special]) > 0
+    return special in game_data['found']
+
+# Live game_data holds some objects (stats, the set of found words) that
+# are converted to and from plain data for storing it as JSON.
+def game_data_to_dict(game_data):
+    d = dict(game_data)
+    d['stats'] = game_data['stats'].to_dict()
+    d.pop('found', None)
+    return d
+
+def game_data_from_dict(d):
+    game_data = dict(d)
+    game_data['stats'] = BoggleStats()
+    game_data['stats'].from_dict(d['stats'])
+    if d['words'] is None:
+        game_data['found'] = None
+    else:
+        game_data['found'] = set(w[0] for w in d['words'])
+    if 'score' not in d:
+        # stored before the score was kept
+        if d['words'] is None:
+            game_data['score'] = None
+        else:
+            game_data['score'] = get_total_score(None, d['words'])
+    return game_data
 
 class BoggleStats:
     def __init__(self):
@@ -301,6 +372,9 @@ class BoggleConsumer(TeamworkTimeConsumer):
             'seed': None,
             'level': None,
             'words': None,
+            # set of the words in words, see game_data_to_dict
+            'found': None,
+            'score': None, # total score of words
             'round_trophies': 0, # bitmask
             'trophies': 0, # bitmask
             'stats': BoggleStats(),
@@ -312,10 +386,7 @@ class BoggleConsumer(TeamworkTimeConsumer):
         data = BoggleTeamData.objects.get_or_create(team=self.team)[0]
 
         try:
-            game_data = json.loads(data.world)
-            stats = BoggleStats()
-            stats.from_dict(game_data['stats'])
-            game_data['stats'] = stats
+            game_data = game_data_from_dict(json.loads(data.world))
         except:
             game_data = self.make_init()
 
@@ -325,8 +396,7 @@ class BoggleConsumer(TeamworkTimeConsumer):
         new_game_data, actions = reducer(game_data, msg)
 
         if new_game_data is not None:
-            new_game_data['stats'] = new_game_data['stats'].to_dict()
-            data.world = json.dumps(new_game_data)
+            data.world = json.dumps(game_data_to_dict(new_game_data))
             data.save()
 
         return actions
@@ -365,11 +435,7 @@ class BoggleConsumer(TeamworkTimeConsumer):
         return True
 
     def stop_game(self, game_data):
-        # found_special = game_get_found_special(game_data)
-        all_words = [
-            w for w in get_game_spec(game_data).wordlist
-            # if found_special or w[0] != get_game_spec(game_data).special
-        ]
+        game_spec = get_game_spec(game_data)
 
         game_data['stats'].update_stats(game_data)
         max_score = game_get_max_score(game_data)
@@ -381,9 +447,11 @@ class BoggleConsumer(TeamworkTimeConsumer):
         game_data['seed'] = None
         game_data['level'] = None
         game_data['words'] = None
+        game_data['found'] = None
+        game_data['score'] = None
         game_data['round_trophies'] = 0
 
-        return self.make_full_update(game_data, True, all_words=all_words)
+        return self.make_full_update(game_data, True, ended_spec=game_spec)
 
     def get_trophy_string(self, game_data):
         res = ''
@@ -403,7 +471,9 @@ class BoggleConsumer(TeamworkTimeConsumer):
             'grade': grade,
         })]
 
-    def make_full_update(self, game_data, broadcast=False, all_words=None):
+    # ended_spec is the spec of a round that just ended, whose words are
+    # sent along
+    def make_full_update(self, game_data, broadcast=False, ended_spec=None):
         is_running = game_data['running']
         max_level = game_data['max_level']
         msg = {
@@ -427,10 +497,7 @@ class BoggleConsumer(TeamworkTimeConsumer):
             msg['totTime'] = self.get_cl_tot_time(game_data)
             msg['words'] = words
             msg['score'] = game_get_score(game_data)
-            msg['grid'] = get_game_spec(game_data).grid
-            msg['bonuses'] = [[k, v] for k, v in get_game_spec(game_data).bonuses.items()]
-            msg['totNumWords'] = game_get_max_num_words(game_data)
-            msg['maxScore'] = game_get_max_score(game_data)
+            msg.update(get_game_spec(game_data).get_static_fields())
             msg['debugSeed'] = game_data['seed']
 
             # special = game_get_special(game_data)
@@ -438,8 +505,9 @@ class BoggleConsumer(TeamworkTimeConsumer):
             # if found_special:
             #     msg['special'] = special
 
-        if all_words is not None:
-            msg['allWords'] = all_words
+        if ended_spec is not None:
+            # the special word is sent too, whether or not it was found
+            msg['allWords'] = ended_spec.wordlist
 
         return [BoggleAction(broadcast, msg)]
 
@@ -456,9 +524,11 @@ class BoggleConsumer(TeamworkTimeConsumer):
         game_data['num_games'] += 1
         game_data['running'] = True
         game_data['start_time'] = datetime.datetime.timestamp(datetime.datetime.now())
-        game_data['seed'] = random.SystemRandom().randrange(1<<28)
+        game_data['seed'] = draw_game_seed(level)
         game_data['level'] = level
         game_data['words'] = []
+        game_data['found'] = set()
+        game_data['score'] = 0
         game_data['round_trophies'] = 0
         # print(game_data['seed'])
         return game_data, self.make_full_update(game_data, True)
@@ -475,11 +545,12 @@ class BoggleConsumer(TeamworkTimeConsumer):
     def get_round_trophies(self, game_data):
         level = game_data['level']
         trophies_per_level = len(GETS_TROPHY_FUNCS)
+        game_spec = get_game_spec(game_data)
 
         trophies = 0
         for i in range(trophies_per_level):
             trophy_index = level * trophies_per_level + i
-            if gets_trophy(game_data, i):
+            if gets_trophy(game_spec, game_data, i):
                 trophies |= 1 << trophy_index
         return trophies
 
@@ -498,15 +569,60 @@ class BoggleConsumer(TeamworkTimeConsumer):
             return game_data, actions
 
         game_spec = get_game_spec(game_data)
-        entries = [w for w in game_spec.wordlist if w[0] == word]
-        if len(entries) == 0:
-            return None, self.make_grade(word, GRADE_WRONG)
-        entry = entries[0]
-        if len([w for w in game_data['words'] if w[0] == entry[0]]) > 0:
-            return None, self.make_grade(word, GRADE_DUPLICATE)
+        grade = self.add_word(game_data, game_spec, word)
+        if grade != GRADE_CORRECT:
+            return None, self.make_grade(word, grade)
+        self.update_trophies(game_data)
 
-        game_data['words'] += [[entry[0], entry[1]]]
+        return game_data, self.make_grade(word, GRADE_CORRECT) + self.make_full_update(game_data, True)
 
+    # like word, for a list of words; answered with a grades message
+    # holding the grade of each word, and at most one full update
+    def handle_words(self, game_data, msg):
+        if not V.has_key(msg, 'words') or not V.is_list(msg['words'], MAX_WORDS_PER_MESSAGE):
+            return None, []
+        words = msg['words']
+        if not all(V.is_str(word) for word in words):
+            return None, []
+
+        if not game_data['running']:
+            return None, self.make_full_update(game_data)
+        if not self.cl_num_games_valid(game_data, msg):
+            return None, self.make_full_update(game_data)
+
+        if self.get_time_left(game_data) < datetime.timedelta():
+            actions = self.stop_game(game_data)
+            return game_data, actions
+
+        game_spec = get_game_spec(game_data)
+        old_num_words = len(game_data['words'])
+        grades = [self.add_word(game_data, game_spec, word) for word in words]
+        actions = [BoggleAction.make_respond({
+            'type': 'grades',
+            'grades': grades,
+        })]
+        num_new = len(game_data['words']) - old_num_words
+        if num_new == 0:
+            return None, actions
+        # trophies only depend on the words found, so checking them once
+        # after all words is the same as after each one
+        self.update_trophies(game_data)
+
+        return game_data, actions + self.make_full_update(game_data, True)
+
+    # grades word, adding it to the words found if it's correct
+    def add_word(self, game_data, game_spec, word):
+        score = game_spec.word_scores.get(word)
+        if score is None:
+            return GRADE_WRONG
+        if word in game_data['found']:
+            return GRADE_DUPLICATE
+        game_data['words'] += [[word, score]]
+        game_data['found'].add(word)
+        game_data['score'] += score
+        return GRADE_CORRECT
+
+    def update_trophies(self, game_data):
         round_trophies = self.get_round_trophies(game_data)
         new_trophies = round_trophies & (~game_data['trophies'])
         game_data['trophies'] |= round_trophies
@@ -522,23 +638,34 @@ class BoggleConsumer(TeamworkTimeConsumer):
                 4
             )
 
-        # TODO: only need to send things that changed
-        return game_data, self.make_grade(word, GRADE_CORRECT) + self.make_full_update(game_data, True)
-
     # used to get full updates, e.g. on join
     def handle_get_update(self, game_data, msg):
         return game_data, self.make_full_update(game_data)
 
     def set_hiscore(self, level, score):
-        data = BoggleHighScoreData.objects.get_or_create(team=self.team, level=level)[0]
+        data, created = BoggleHighScoreData.objects.get_or_create(team=self.team, level=level)
         if score > data.score:
             data.score = score
             data.save()
+        elif not created:
+            return
+        # only once committed, so other workers don't cache the old scores
+        transaction.on_commit(lambda: cache.delete(HISCORES_CACHE_KEY % level))
+
+    # [(team id, team name, score)], best first, cached until it changes
+    def get_leaderboard(self, level):
+        key = HISCORES_CACHE_KEY % level
+        leaderboard = cache.get(key)
+        if leaderboard is None:
+            leaderboard = list(BoggleHighScoreData.objects.filter(level=level).order_by('-score').values_list('team_id', 'team__name', 'score'))
+            cache.set(key, leaderboard, HISCORES_CACHE_TIMEOUT)
+        return leaderboard
 
     def get_hiscores(self, level):
-        if not BoggleHighScoreData.objects.filter(level=level).filter(team=self.team).exists():
+        leaderboard = self.get_leaderboard(level)
+        if not any(team_id == self.team.id for team_id, name, score in leaderboard):
             return None
-        scores = list(BoggleHighScoreData.objects.filter(level=level).order_by('-score').values_list('team__name', 'score'))
+        scores = [(name, score) for team_id, name, score in leaderboard]
         # TODO: add real high score
         # scores += [('✈️✈️✈️ Galactic Trendsetters ✈️✈️✈️', int(0.9 * HISCORE_SCALE))]
         # scores.sort(key=lambda t: t[1], reverse=True)
@@ -569,6 +696,7 @@ class BoggleConsumer(TeamworkTimeConsumer):
             'start': self.handle_start,
             'stop': self.handle_stop,
             'word': self.handle_word,
+            'words': self.handle_words,
             'getUpdate': self.handle_get_update,
         }
 
@@ -0,0 +1,129 @@
+import collections
+import threading
+import time
+
+# seconds between sweeps for pins of rounds that were never stopped
+PIN_SWEEP_INTERVAL = 60
+
+# LRU cache of game specs keyed by (level, seed), generating missing specs
+# with gen_game_spec. Entries unused for longer than ttl seconds (if set)
+# are dropped.
+#
+# Specs of running games are pinned until their round is over: pinned
+# entries don't count towards size and are never evicted, so a spec can't
+# be thrown away and re-solved in the middle of a round. Pins expire by
+# themselves, so rounds that are abandoned without a stop don't leak.
+class GameSpecCache:
+    def __init__(self, gen_game_spec, size, ttl=None):
+        self.gen_game_spec = gen_game_spec
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # key -> (last used, spec), least recently used first
+        self.lru = collections.OrderedDict()
+        # key -> (pinned until, spec)
+        self.pinned = {}
+        self.next_pin_sweep = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # returns the spec for key, generating it if needed; if pin_until is
+    # given, the spec is kept at least until then
+    def get(self, key, pin_until=None):
+        now = time.time()
+        with self.lock:
+            game_spec = self.lookup(key, now)
+            if game_spec is not None:
+                self.hits += 1
+                self.store(key, game_spec, pin_until, now)
+                return game_spec
+            self.misses += 1
+
+        # generated without holding the lock, so other games aren't blocked
+        game_spec = self.gen_game_spec(*key)
+        self.put(key, game_spec, pin_until)
+        return game_spec
+
+    def put(self, key, game_spec, pin_until=None):
+        now = time.time()
+        with self.lock:
+            self.store(key, game_spec, pin_until, now)
+
+    def discard(self, key):
+        with self.lock:
+            self.lru.pop(key, None)
+            self.pinned.pop(key, None)
+
+    def __contains__(self, key):
+        with self.lock:
+            return self.lookup(key, time.time()) is not None
+
+    def __len__(self):
+        return len(self.lru) + len(self.pinned)
+
+    def stats(self):
+        return {
+            'size': len(self),
+            'pinned': len(self.pinned),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    # the following must be called with lock held
+
+    # finds key without changing its recency; expired pins are unpinned
+    def lookup(self, key, now):
+        if key in self.pinned:
+            pinned_until, game_spec = self.pinned[key]
+            if pinned_until > now:
+                return game_spec
+            del self.pinned[key]
+            self.lru[key] = (now, game_spec)
+            self.lru.move_to_end(key)
+            return game_spec
+        if key in self.lru:
+            last_used, game_spec = self.lru[key]
+            if self.ttl is None or now - last_used <= self.ttl:
+                return game_spec
+            del self.lru[key]
+            self.evictions += 1
+        return None
+
+    def store(self, key, game_spec, pin_until, now):
+        if key in self.pinned:
+            old_pin_until = self.pinned[key][0]
+            if pin_until is None or pin_until < old_pin_until:
+                pin_until = old_pin_until
+        if pin_until is not None and pin_until > now:
+            self.lru.pop(key, None)
+            self.pinned[key] = (pin_until, game_spec)
+        else:
+            self.pinned.pop(key, None)
+            self.lru[key] = (now, game_spec)
+            self.lru.move_to_end(key)
+        self.evict(now)
+
+    def evict(self, now):
+        if now >= self.next_pin_sweep:
+            self.next_pin_sweep = now + PIN_SWEEP_INTERVAL
+            expired = [
+                key for key, (pinned_until, game_spec) in self.pinned.items()
+                if pinned_until <= now
+            ]
+            for key in expired:
+                pinned_until, game_spec = self.pinned.pop(key)
+                # unused since the round ended, so first in line for eviction
+                self.lru[key] = (pinned_until, game_spec)
+                self.lru.move_to_end(key, last=False)
+        while len(self.lru) > self.size:
+            self.lru.popitem(last=False)
+            self.evictions += 1
+        while self.ttl is not None and len(self.lru) > 0:
+            key, (last_used, game_spec) = next(iter(self.lru.items()))
+            if now - last_used <= self.ttl:
+                break
+            del self.lru[key]
+            self.evictions += 1
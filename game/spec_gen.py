@@ -0,0 +1,82 @@
+import random
+import sqlite3
+
+from .gen_grid import gen_grid
+from .gen_grid_list import _get_score_dict, lexicon_fingerprint
+from .topology import get_game_topology_level
+from .spec_store import GameSpecStore
+from .metrics import Counter, Histogram
+
+# Generates the specs of the posthunt game from their level and seed.
+# Kept apart from game.game and its game state, so clients such as
+# posthunt/loadgen.py can find the words of a round like the server does.
+
+# bump whenever gen_grid or gen_spec change what a seed generates
+GENERATOR_VERSION = 1
+
+gen_game_spec_seconds = Histogram(
+    'boggle_gen_game_spec_seconds', 'Time taken by gen_game_spec', ['level']
+)
+gen_game_spec_grids = Counter(
+    'boggle_gen_game_spec_grids_total', 'Grids generated and solved by gen_game_spec', ['level']
+)
+
+# version of the specs gen_spec generates, for keying them in a
+# GameSpecStore
+def get_spec_store_version():
+    return '%d-%s' % (GENERATOR_VERSION, lexicon_fingerprint())
+
+# the GameSpecStore at path for the specs gen_spec generates, or None if
+# path is None; the lexicon is only fingerprinted once the store is used
+def open_spec_store(path):
+    if path is None:
+        return None
+    return GameSpecStore(path, get_spec_store_version)
+
+def store_spec(store, level, seed, spec):
+    if store is None:
+        return
+    try:
+        store.put(level, seed, *spec)
+    except sqlite3.Error as e:
+        print('failed to store spec %s: %r' % ((level, seed), e))
+
+# like gen_spec, but reuses a spec solved before (maybe by another
+# process) if store has it
+def load_spec(store, level, seed):
+    if store is not None:
+        try:
+            spec = store.get(level, seed)
+        except sqlite3.Error as e:
+            print('failed to load spec %s: %r' % ((level, seed), e))
+            spec = None
+        if spec is not None:
+            return spec
+    spec = gen_spec(level, seed)
+    store_spec(store, level, seed, spec)
+    return spec
+
+# returns (grid, bonuses, wordlist, special)
+def gen_spec(level, seed):
+    with gen_game_spec_seconds.time(level):
+        return _gen_spec(level, seed)
+
+def _gen_spec(level, seed):
+    cutoff = 105
+    invalid_grid = True
+    rand_obj = random.Random(seed)
+
+    gen_level = get_game_topology_level(level)
+    while invalid_grid:
+        grid, bonuses, special = gen_grid(gen_level, rand_obj)
+        gen_game_spec_grids.inc(level)
+        wordlist = [
+            (word, score) for word, score in
+            _get_score_dict(grid, gen_level, bonuses).items()
+        ]
+        if len(wordlist) >= cutoff:
+            invalid_grid = False
+        else:
+            cutoff -= 5
+
+    return grid, bonuses, wordlist, special
@@ -0,0 +1,64 @@
+import collections
+import concurrent.futures
+import functools
+import random
+import threading
+
+# Keeps a few game specs per level generated ahead of time, so starting a
+# round can use a seed whose spec is already solved instead of solving one
+# while the players wait. Specs are generated on an executor (one worker
+# thread unless start() is given another one, e.g. a process pool) and the
+# pool refills itself whenever a spec is taken.
+class GameSpecPool:
+    def __init__(self, gen_game_spec, levels, size):
+        self.gen_game_spec = gen_game_spec
+        self.levels = levels
+        self.size = size
+        self.executor = None
+        self.lock = threading.Lock()
+        self.ready = {level: collections.deque() for level in levels}
+        self.pending = {level: 0 for level in levels}
+
+    def start(self, executor=None):
+        with self.lock:
+            if self.executor is None:
+                if executor is None:
+                    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+                self.executor = executor
+        for level in self.levels:
+            self.refill(level)
+
+    def refill(self, level):
+        with self.lock:
+            missing = self.size - len(self.ready[level]) - self.pending[level]
+            if missing <= 0:
+                return
+            self.pending[level] += missing
+        for i in range(missing):
+            seed = random.SystemRandom().randrange(1<<28)
+            future = self.executor.submit(self.gen_game_spec, level, seed)
+            future.add_done_callback(functools.partial(self.on_generated, level, seed))
+
+    def on_generated(self, level, seed, future):
+        with self.lock:
+            self.pending[level] -= 1
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            print('failed to pregenerate spec %s: %r' % ((level, seed), future.exception()))
+            return
+        self.ready[level].append((seed, future.result()))
+
+    # returns (seed, game_spec) for a ready spec, or None if there is none
+    def pop(self, level):
+        if self.executor is None:
+            self.start()
+        try:
+            entry = self.ready[level].popleft()
+        except IndexError:
+            entry = None
+        self.refill(level)
+        return entry
+
+    def num_ready(self, level):
+        return len(self.ready[level])
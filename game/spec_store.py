@@ -0,0 +1,123 @@
+import datetime
+import json
+import os
+import sqlite3
+import threading
+import zlib
+
+# Persistent store of solved game specs keyed by (level, seed), so a spec
+# is only ever solved once per host: after a restart, or by another worker
+# process sharing the same file, it is read back instead of re-solved.
+#
+# Specs are only valid for the dictionary and generator that produced them,
+# so rows are also keyed by version; specs of other versions are ignored
+# until compact() deletes them.
+#
+# The database is only opened, and the version computed by get_version
+# (which may need the dictionary loaded), when the store is first used.
+#
+# Each spec is stored as zlib-compressed JSON of
+# [grid, bonuses as [[cell], multiplier] pairs, wordlist, special].
+class GameSpecStore:
+    def __init__(self, path, get_version):
+        self.path = path
+        self.get_version = get_version
+        self.version = None
+        self.db = None
+        self.lock = threading.Lock()
+
+    # called with the lock held
+    def open(self):
+        if self.db is not None:
+            return
+        self.version = self.get_version()
+        dirname = os.path.dirname(self.path)
+        if dirname != '':
+            os.makedirs(dirname, exist_ok=True)
+        db = sqlite3.connect(self.path, check_same_thread=False, timeout=10)
+        # WAL lets worker processes read while another one writes
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute(' '.join([
+            'CREATE TABLE IF NOT EXISTS boggle_game_specs (',
+            'version TEXT NOT NULL,',
+            'level INTEGER NOT NULL,',
+            'seed INTEGER NOT NULL,',
+            'spec BLOB NOT NULL,',
+            'created INTEGER NOT NULL,',
+            'PRIMARY KEY(version, level, seed)',
+            ')',
+        ]))
+        db.execute(' '.join([
+            'CREATE INDEX IF NOT EXISTS boggle_game_specs_version_created',
+            'ON boggle_game_specs (version, created)',
+        ]))
+        db.commit()
+        self.db = db
+
+    # returns (grid, bonuses, wordlist, special), or None if not stored
+    def get(self, level, seed):
+        with self.lock:
+            self.open()
+            c = self.db.cursor()
+            c.execute(' '.join([
+                'SELECT spec FROM boggle_game_specs',
+                'WHERE version = ? AND level = ? AND seed = ?',
+            ]), (self.version, level, seed))
+            entry = c.fetchone()
+        if entry is None:
+            return None
+        grid, bonuses, wordlist, special = json.loads(zlib.decompress(entry[0]))
+        return (
+            grid,
+            {tuple(cell): mult for cell, mult in bonuses},
+            [(word, score) for word, score in wordlist],
+            special,
+        )
+
+    def put(self, level, seed, grid, bonuses, wordlist, special):
+        spec = zlib.compress(json.dumps([
+            grid,
+            [[list(cell), mult] for cell, mult in bonuses.items()],
+            wordlist,
+            special,
+        ], separators=(',', ':')).encode())
+        created = datetime.datetime.now().timestamp()
+        with self.lock:
+            self.open()
+            self.db.execute(' '.join([
+                'INSERT OR IGNORE INTO boggle_game_specs',
+                '(version, level, seed, spec, created)',
+                'VALUES (?, ?, ?, ?, ?)',
+            ]), (self.version, level, seed, spec, created))
+            self.db.commit()
+
+    # deletes the specs of other versions and all but the kept most
+    # recently created ones of this version (and those created at the same
+    # time as the last kept one), and returns the number of rows deleted;
+    # deleted specs are solved again when next needed
+    def compact(self, kept):
+        with self.lock:
+            self.open()
+            # committed, or rolled back if anything fails
+            with self.db:
+                c = self.db.cursor()
+                c.execute(' '.join([
+                    'DELETE FROM boggle_game_specs',
+                    'WHERE version != ?',
+                ]), (self.version,))
+                deleted = c.rowcount
+                c.execute(' '.join([
+                    'SELECT created FROM boggle_game_specs',
+                    'WHERE version = ?',
+                    'ORDER BY created DESC',
+                    'LIMIT 1 OFFSET ?',
+                ]), (self.version, kept - 1))
+                entry = c.fetchone()
+                if entry is not None:
+                    c.execute(' '.join([
+                        'DELETE FROM boggle_game_specs',
+                        'WHERE version = ? AND created < ?',
+                    ]), (self.version, entry[0]))
+                    deleted += c.rowcount
+        return deleted
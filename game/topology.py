@@ -0,0 +1,137 @@
+import itertools
+import math
+
+# A topology describes one board shape: which cells exist and are playable,
+# the bonus cells, the path the Carroll word is laid along and which cells
+# are adjacent. Everything the solver needs is precomputed here once, at
+# import time.
+#
+# Cells are numbered by flat index, in the order of the nested grid lists
+# (grid[i][j] or grid[i][j][k]). Coordinates are the nested indices
+# reversed, i.e. (x, y) for grid[y][x] and (x, y, z) for grid[z][y][x],
+# which is what bonuses and solver paths use.
+class Topology:
+    def __init__(self, name, template, bonuses, carroll_path, neighbor_rule):
+        self.name = name
+        self.template = template
+        dims = []
+        t = template
+        while isinstance(t, list):
+            dims.append(len(t))
+            t = t[0]
+        self.dims = tuple(dims)
+
+        nested = list(itertools.product(*[range(d) for d in self.dims]))
+        self.cells = [tuple(reversed(n)) for n in nested]
+        self.index = {cell: i for i, cell in enumerate(self.cells)}
+        self.mask = [self.get(template, cell) == '@' for cell in self.cells]
+
+        self.bonuses = bonuses
+        self.bonus_mults = [bonuses.get(cell, 1) for cell in self.cells]
+
+        # path positions number the cells with the first nested index
+        # varying fastest
+        self.carroll_path = []
+        for pos in carroll_path:
+            n = []
+            for d in self.dims:
+                n.append(pos % d)
+                pos //= d
+            self.carroll_path.append(self.index[tuple(reversed(n))])
+
+        self.neighbor_cells = {
+            cell: tuple(
+                n for n in neighbor_rule(*cell)
+                if n != cell and n in self.index
+            )
+            for cell in self.cells
+        }
+        self.neighbors = [
+            tuple(self.index[n] for n in self.neighbor_cells[cell])
+            for cell in self.cells
+        ]
+
+    def get(self, grid, cell):
+        for i in reversed(cell):
+            grid = grid[i]
+        return grid
+
+    # grid (nested lists) -> list of letters by flat index
+    def flatten(self, grid):
+        return [self.get(grid, cell) for cell in self.cells]
+
+    # list of letters by flat index -> grid (nested lists)
+    def unflatten(self, letters):
+        def build(offset, dims):
+            if len(dims) == 0:
+                return letters[offset]
+            stride = math.prod(dims[1:])
+            return [build(offset + i * stride, dims[1:]) for i in range(dims[0])]
+        return build(0, self.dims)
+
+def square_neighbors(x, y):
+    for nx in range(x-1, x+2):
+        for ny in range(y-1, y+2):
+            yield (nx, ny)
+
+def hex_neighbors(x, y):
+    for nx in range(x-1, x+2):
+        for ny in range(y-1, y+2):
+            if (nx-x) != (ny-y):
+                yield (nx, ny)
+
+def knight_neighbors(x, y):
+    d = ((1,2),(2,1),(-1,2),(-2,1),(-1,-2),(-2,-1),(1,-2),(2,-1))
+    for dd in d:
+        yield (dd[0]+x, dd[1]+y)
+
+def cube_neighbors(x, y, z):
+    d = ((0,0,1),(0,1,0),(1,0,0),(0,0,-1),(0,-1,0),(-1,0,0))
+    for dd in d:
+        yield (dd[0]+x, dd[1]+y, dd[2]+z)
+
+# indexed by generator/solver level
+TOPOLOGIES = []
+
+def register_topology(topology):
+    TOPOLOGIES.append(topology)
+    return len(TOPOLOGIES) - 1
+
+def get_topology(level):
+    return TOPOLOGIES[level]
+
+register_topology(Topology(
+    'square',
+    [["#", "#", "#", "#", "#", "#"],["#", "@", "@", "@", "@", "#"],["#", "@", "@", "@", "@", "#"],["#", "@", "@", "@", "@", "#"],["#", "@", "@", "@", "@", "#"],["#", "#", "#", "#", "#", "#"]],
+    {(1,1):2,(4,4):3},
+    (7,8,15,10,9,16,22,28,27,26,21,14,19,25,20,13),
+    square_neighbors,
+))
+register_topology(Topology(
+    'hex',
+    [["#", "#", "@", "@", "@"], ["#", "@", "@", "@", "@"], ["@", "@", "@", "@", "@"], ["@", "@", "@", "@", "#"], ["@", "@", "@", "#", "#"]],
+    {(0,2):2,(2,4):2,(4,0):2},
+    (2,7,12,8,3,4,9,14,18,13,17,22,21,20,16,15,10,11,6),
+    hex_neighbors,
+))
+register_topology(Topology(
+    'knight',
+    [["#", "#", "@", "@", "#", "#"],["#", "@", "@", "@", "@", "#"],["@", "@", "@", "@", "@", "@"],["@", "@", "@", "@", "@", "@"],["#", "@", "@", "@", "@", "#"],["#", "#", "@", "@", "#", "#"]],
+    {(0,2):2,(5,3):2,(2,5):3,(3,0):3},
+    (2,10,23,27,16,3,14,25,12,8,21,32,19,15,7,18,26,22,33,20,28,17,9,13),
+    knight_neighbors,
+))
+register_topology(Topology(
+    'cube',
+    [[["@", "@", "@"],["@", "@", "@"],["@", "@", "@"]],[["@", "@", "@"],["@", "@", "@"],["@", "@", "@"]],[["@", "@", "@"],["@", "@", "@"],["@", "@", "@"]]],
+    {(0,0,0):2,(0,2,2):3,(2,2,0):3,(2,0,2):2},
+    (0,1,2,11,14,23,26,17,16,25,22,19,18,21,24,15,6,7,8,5,4,13,10,9,12,3),
+    cube_neighbors,
+))
+
+# game levels are played in a different order than the topologies are
+# registered: game level i uses topology GAME_LEVEL_TOPOLOGIES[i]
+GAME_LEVEL_TOPOLOGIES = [0, 1, 3, 2]
+
+def get_game_topology_level(level):
+    return GAME_LEVEL_TOPOLOGIES[level]
@@ -45,6 +45,15 @@ class Validator:
             return False
         return True
 
+    def is_list(x, max_len=None):
+        if type(x) != list:
+            Validator.raise_assert()
+            return False
+        if max_len is not None and len(x) > max_len:
+            Validator.raise_assert()
+            return False
+        return True
+
     def is_bool(x):
         if type(x) != bool:
             Validator.raise_assert()
@@ -0,0 +1,134 @@
+import sqlite3
+import threading
+
+from .metrics import Histogram
+
+# Buffers writes to an SQLite database and writes them from a background
+# thread, in one transaction per flush, so callers never wait for the disk.
+# Writes are flushed every interval seconds, or sooner once max_pending are
+# buffered, and by close() on shutdown. Writes after close() (e.g. by
+# reducers still running on shutdown) are flushed right away.
+#
+# Rows are upserted by key: a row written again before it is flushed just
+# replaces the buffered one. Rows that are buffered or being flushed can be
+# read back with get() and rows(), so readers of the database should check
+# those first.
+#
+# The writer uses its own connection, so with WAL other connections can
+# keep reading while it commits.
+
+flush_seconds = Histogram('boggle_db_flush_seconds', 'Time taken to write a flush to the database')
+
+class WriteBehind:
+    def __init__(self, path, interval, max_pending):
+        self.interval = interval
+        self.max_pending = max_pending
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        # table -> insert statement
+        self.inserts = {}
+        self.lock = threading.Lock()
+        # only one flush at a time, so flushes are written in order
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        # table -> key -> row
+        self.pending = {}
+        self.flushing = {}
+        self.num_pending = 0
+        self.thread = None
+        self.closed = False
+
+        self.flushes = 0
+        self.rows_written = 0
+        self.errors = 0
+
+    # insert is an INSERT OR REPLACE statement taking a whole row
+    def add_table(self, table, insert):
+        self.inserts[table] = insert
+        self.pending[table] = {}
+        self.flushing[table] = {}
+
+    def put(self, table, key, row):
+        with self.lock:
+            closed = self.closed
+            if self.thread is None and not closed:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            if key not in self.pending[table]:
+                self.num_pending += 1
+            self.pending[table][key] = row
+            if self.num_pending >= self.max_pending:
+                self.wakeup.set()
+        if closed:
+            # no thread flushes it any more
+            self.flush()
+
+    # the row for key that isn't written yet, or None
+    def get(self, table, key):
+        with self.lock:
+            if key in self.pending[table]:
+                return self.pending[table][key]
+            return self.flushing[table].get(key)
+
+    # all rows of table that aren't written yet
+    def rows(self, table):
+        with self.lock:
+            rows = dict(self.flushing[table])
+            rows.update(self.pending[table])
+        return list(rows.values())
+
+    def run(self):
+        while not self.closed:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                if self.num_pending == 0:
+                    return
+                self.flushing, self.pending = self.pending, self.flushing
+                self.num_pending = 0
+            try:
+                with flush_seconds.time(), self.db:
+                    for table, rows in self.flushing.items():
+                        if len(rows) > 0:
+                            self.db.executemany(self.inserts[table], rows.values())
+                self.flushes += 1
+                self.rows_written += sum(len(rows) for rows in self.flushing.values())
+            except sqlite3.Error as e:
+                print('failed to write %d rows: %r' % (
+                    sum(len(rows) for rows in self.flushing.values()), e
+                ))
+                self.errors += 1
+                # retried with the next flush, unless written again since
+                with self.lock:
+                    for table, rows in self.flushing.items():
+                        for key, row in rows.items():
+                            if key not in self.pending[table]:
+                                self.pending[table][key] = row
+                                self.num_pending += 1
+            with self.lock:
+                for rows in self.flushing.values():
+                    rows.clear()
+
+    # flushes everything and makes it durable
+    def close(self):
+        with self.lock:
+            self.closed = True
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+        with self.flush_lock:
+            self.db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def stats(self):
+        return {
+            'pending': self.num_pending,
+            'flushes': self.flushes,
+            'rows_written': self.rows_written,
+            'errors': self.errors,
+        }
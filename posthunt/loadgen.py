@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import collections
+import json
+import os
+import random
+import string
+import sys
+import time
+import urllib.parse
+import urllib.request
+import zlib
+
+import websockets
+
+# Simulates teams playing against a local posthunt-server.py, for
+# capacity planning. Each team has several members, each on its own
+# connection; one of them starts and stops the team's rounds. During a
+# round every member submits words at random intervals, a mix of words
+# of the round's spec (found from its debugSeed like the server does, so
+# members also find each other's words) and wrong ones.
+#
+# Reports the words graded per second and the latency from sending a
+# word to receiving its grade, and counts connections the server closed,
+# e.g. for falling behind (more than 200 messages waiting to be sent to
+# them, or a full team backlog). Slow readers can be simulated to provoke
+# that; their grades are left out of the latency, which their reading
+# delays. With --metrics-url (see posthunt-server.py --metrics-port, and
+# --workers to add up its workers' metrics) the server's count of the
+# connections it dropped for unsent messages is reported too.
+#
+# usage: python3 posthunt/loadgen.py [--teams N] [--members N] [--duration S] ...
+
+# like posthunt-server.py, so specs stored by the server are found
+os.chdir(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, '.')
+
+# not game.game, which holds the server's game state
+from game.encoding import COMPACT_KEYS, DELTA_VERSION
+from game.spec_gen import open_spec_store, load_spec
+
+URL = 'ws://localhost:29782'
+# game.game.SPEC_STORE_PATH; specs missing from it are solved here
+SPEC_STORE_PATH = 'db/specs.sqlite'
+
+COMPACT_NAMES = {short: name for name, short in COMPACT_KEYS.items()}
+
+stats = {
+    'connected': 0,
+    'connect_errors': 0,
+    'server_closes': 0,
+    'rounds_started': 0,
+    'words_sent': 0,
+    'grades': 0,
+    'wrong': 0,
+    'duplicate': 0,
+    'correct': 0,
+    'full_updates': 0,
+    'deltas': 0,
+}
+# seconds from sending a word to receiving its grade, since the last report
+latencies = []
+all_latencies = []
+
+# the server's spec store, or None if there is none
+spec_store = None
+# (level, seed) -> future of the list of the words of the spec
+spec_words = {}
+
+# runs in an executor, as solving a spec takes a while
+def load_spec_words(level, seed):
+    grid, bonuses, wordlist, special = load_spec(spec_store, level, seed)
+    return [word for word, score in wordlist]
+
+def get_spec_words(level, seed):
+    if (level, seed) not in spec_words:
+        spec_words[(level, seed)] = asyncio.get_running_loop().run_in_executor(
+            None, load_spec_words, level, seed
+        )
+    return spec_words[(level, seed)]
+
+def decode(frame):
+    if isinstance(frame, str):
+        return json.loads(frame)
+    if frame[:1] == b'\x01':
+        data = zlib.decompress(frame[1:])
+    else:
+        data = frame[1:]
+    msg = json.loads(data)
+    return {COMPACT_NAMES.get(k, k): v for k, v in msg.items()}
+
+def percentile(values, p):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+def format_ms(seconds):
+    if seconds is None:
+        return '-'
+    return '%.1fms' % (seconds * 1000,)
+
+def make_wrong_word(rand):
+    return ''.join(rand.choice(string.ascii_lowercase) for i in range(rand.randint(3, 8)))
+
+class Member:
+    def __init__(self, args, team, is_leader, slow, rand):
+        self.args = args
+        self.team = team
+        self.is_leader = is_leader
+        self.slow = slow
+        self.rand = rand
+        self.ws = None
+        self.closing = False
+        self.num_games = 0
+        self.max_level = 0
+        self.running = False
+        # future of the words of the running round's spec
+        self.words = None
+        # word -> send times of the words waiting for a grade
+        self.pending = collections.defaultdict(collections.deque)
+        # when the leader last started or stopped a round; long ago, so
+        # the first round is started right away
+        self.round_changed = 0
+
+    async def run(self, deadline):
+        try:
+            # slow members leave messages in the socket, so the server
+            # has to queue them
+            self.ws = await websockets.connect(
+                self.args.url, max_queue=1 if self.slow else None
+            )
+        except (OSError, websockets.exceptions.WebSocketException):
+            stats['connect_errors'] += 1
+            return
+        stats['connected'] += 1
+        auth = {'type': 'AUTH', 'data': self.team}
+        if self.args.compact:
+            auth['encoding'] = 'compact'
+        if not self.args.full_updates:
+            auth['deltas'] = DELTA_VERSION
+        reader = asyncio.create_task(self.read())
+        try:
+            await self.ws.send(json.dumps(auth))
+            await self.ws.send(json.dumps({'type': 'getUpdate'}))
+            await self.play(deadline)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        self.closing = True
+        reader.cancel()
+        await self.ws.close()
+        stats['connected'] -= 1
+
+    async def read(self):
+        try:
+            async for frame in self.ws:
+                if self.slow:
+                    await asyncio.sleep(self.args.slow_delay)
+                self.receive(decode(frame))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        if not self.closing:
+            stats['server_closes'] += 1
+
+    def receive(self, msg):
+        msg_type = msg.get('type')
+        if msg_type == 'grade':
+            sent = self.pending.get(msg['word'])
+            if sent:
+                latency = time.monotonic() - sent.popleft()
+                if not self.slow:
+                    latencies.append(latency)
+                    all_latencies.append(latency)
+            stats['grades'] += 1
+            stats[('wrong', 'duplicate', 'correct')[msg['grade']]] += 1
+        elif msg_type == 'full':
+            stats['full_updates'] += 1
+            self.num_games = msg['numGames']
+            self.max_level = msg['maxLevel']
+            if self.running != msg['running']:
+                self.round_changed = time.monotonic()
+            self.running = msg['running']
+            if self.running:
+                self.words = get_spec_words(msg['level'], msg['debugSeed'])
+            else:
+                self.words = None
+        elif msg_type == 'delta':
+            stats['deltas'] += 1
+            self.num_games = msg['numGames']
+
+    async def play(self, deadline):
+        while time.monotonic() < deadline and not self.ws.closed:
+            await asyncio.sleep(self.rand.expovariate(1 / self.args.word_interval))
+            if self.is_leader:
+                await self.lead()
+            if self.running and self.words is not None and self.words.done():
+                await self.send_word()
+
+    async def lead(self):
+        since_change = time.monotonic() - self.round_changed
+        if not self.running and since_change >= self.args.round_pause:
+            level = self.rand.randint(0, min(self.max_level, 3))
+            await self.ws.send(json.dumps({'type': 'start', 'level': level}))
+            stats['rounds_started'] += 1
+            # wait for the update rather than starting again
+            self.round_changed = time.monotonic()
+        elif self.running and since_change >= self.args.round_length:
+            await self.ws.send(json.dumps({'type': 'stop', 'numGames': self.num_games}))
+            self.round_changed = time.monotonic()
+
+    async def send_word(self):
+        if self.rand.random() < self.args.wrong_fraction:
+            word = make_wrong_word(self.rand)
+        else:
+            word = self.rand.choice(self.words.result())
+        self.pending[word].append(time.monotonic())
+        await self.ws.send(json.dumps({
+            'type': 'word', 'word': word, 'numGames': self.num_games,
+        }))
+        stats['words_sent'] += 1
+
+# metrics_url, and those of the server's workers, which serve theirs on
+# the next ports (see get_worker_metrics_port in posthunt-server.py)
+def get_metrics_urls(metrics_url, workers):
+    if metrics_url is None:
+        return []
+    url = urllib.parse.urlsplit(metrics_url)
+    urls = [metrics_url]
+    for worker in range(workers):
+        netloc = '%s:%d' % (url.hostname, url.port + 1 + worker)
+        urls.append(url._replace(netloc=netloc).geturl())
+    return urls
+
+# the server's count of connections dropped for unsent messages, summed
+# over metrics_urls, or None if there are none or one can't be read
+def get_dropped_connections(metrics_urls):
+    if len(metrics_urls) == 0:
+        return None
+    dropped = 0
+    for metrics_url in metrics_urls:
+        try:
+            with urllib.request.urlopen(metrics_url) as f:
+                lines = f.read().decode().split('\n')
+        except OSError as e:
+            print('failed to read metrics: %r' % (e,))
+            return None
+        # a process that never dropped one may have no sample
+        for line in lines:
+            if line.startswith('posthunt_dropped_connections_total '):
+                dropped += float(line.split()[1])
+    return dropped
+
+async def report(interval, start):
+    last_grades = 0
+    while True:
+        await asyncio.sleep(interval)
+        print('%5.0fs: %d connected, %.0f grades/s, p50 %s, p99 %s, %d closed by server' % (
+            time.monotonic() - start, stats['connected'],
+            (stats['grades'] - last_grades) / interval,
+            format_ms(percentile(latencies, 0.5)), format_ms(percentile(latencies, 0.99)),
+            stats['server_closes'],
+        ))
+        last_grades = stats['grades']
+        latencies.clear()
+
+async def main(args):
+    global spec_store
+    # opened only if the server made it, rather than creating it
+    if os.path.exists(SPEC_STORE_PATH):
+        spec_store = open_spec_store(SPEC_STORE_PATH)
+    rand = random.Random(args.seed)
+    metrics_urls = get_metrics_urls(args.metrics_url, args.workers)
+    dropped_before = get_dropped_connections(metrics_urls)
+    start = time.monotonic()
+    deadline = start + args.duration
+    reporter = asyncio.create_task(report(args.report_interval, start))
+    members = []
+    for team in range(args.teams):
+        for member in range(args.members):
+            members.append(Member(
+                args, '%s%d' % (args.team_prefix, team), member == 0,
+                rand.random() < args.slow_fraction, random.Random(rand.random())
+            ))
+    tasks = []
+    # connections are opened at connect_rate per second
+    for member in members:
+        tasks.append(asyncio.create_task(member.run(deadline)))
+        await asyncio.sleep(1 / args.connect_rate)
+    # throughput is measured while the members play, not while they close
+    await asyncio.sleep(max(0, deadline - time.monotonic()))
+    elapsed = time.monotonic() - start
+    grades = stats['grades']
+    await asyncio.gather(*tasks)
+    reporter.cancel()
+    dropped_after = get_dropped_connections(metrics_urls)
+
+    print('%d teams of %d members for %.0fs' % (args.teams, args.members, elapsed))
+    print('rounds started: %d' % (stats['rounds_started'],))
+    print('words sent: %d, graded: %d (%d correct, %d duplicate, %d wrong), not graded: %d' % (
+        stats['words_sent'], stats['grades'], stats['correct'], stats['duplicate'],
+        stats['wrong'], sum(len(sent) for m in members for sent in m.pending.values()),
+    ))
+    print('full updates: %d, deltas: %d' % (stats['full_updates'], stats['deltas']))
+    print('throughput: %.1f grades/s' % (grades / elapsed,))
+    print('grade latency: p50 %s, p99 %s, max %s' % (
+        format_ms(percentile(all_latencies, 0.5)), format_ms(percentile(all_latencies, 0.99)),
+        format_ms(max(all_latencies, default=None)),
+    ))
+    print('failed connects: %d, closed by server: %d' % (
+        stats['connect_errors'], stats['server_closes'],
+    ))
+    if dropped_before is not None and dropped_after is not None:
+        print('dropped by the server for unsent messages: %d' % (dropped_after - dropped_before,))
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--url', default=URL, help='server to connect to')
+parser.add_argument('--teams', type=int, default=100, help='number of teams')
+parser.add_argument('--members', type=int, default=4, help='connections per team')
+parser.add_argument('--duration', type=float, default=60, help='seconds to play for')
+parser.add_argument('--word-interval', type=float, default=2,
+    help='mean seconds between words of a member')
+parser.add_argument('--wrong-fraction', type=float, default=0.3,
+    help='fraction of the words sent that are wrong')
+parser.add_argument('--round-length', type=float, default=30,
+    help='seconds after which leaders stop their rounds')
+parser.add_argument('--round-pause', type=float, default=5,
+    help='seconds between the rounds of a team')
+parser.add_argument('--slow-fraction', type=float, default=0,
+    help='fraction of the members that are slow to read')
+parser.add_argument('--slow-delay', type=float, default=0.5,
+    help='seconds slow members take to read each message')
+parser.add_argument('--compact', action='store_true', help='use the compact encoding')
+parser.add_argument('--full-updates', action='store_true',
+    help="don't accept deltas, like clients from before them")
+parser.add_argument('--connect-rate', type=float, default=200,
+    help='connections opened per second')
+parser.add_argument('--team-prefix', default='loadgen-', help='prefix of the team names')
+parser.add_argument('--seed', type=int, default=0, help='seed of the simulated play')
+parser.add_argument('--report-interval', type=float, default=5,
+    help='seconds between progress reports')
+parser.add_argument('--metrics-url', default=None,
+    help='metrics of the server, e.g. http://localhost:9109/metrics')
+parser.add_argument('--workers', type=int, default=0,
+    help='workers of the server (see its --workers), whose metrics are added')
+
+if __name__ == '__main__':
+    asyncio.run(main(parser.parse_args()))
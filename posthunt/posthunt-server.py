@@ -15,167 +15,430 @@ import types
 import datetime
 import sqlite3
 import ssl
+import signal
 import pathlib
 import urllib.parse
+import concurrent.futures
+import argparse
+import subprocess
+import zlib
+import socket
+import functools
+import struct
+import websockets.frames
+import websockets.server
+import websockets.legacy.server
+from websockets.extensions.permessage_deflate import (
+    PerMessageDeflate, ServerPerMessageDeflateFactory,
+)
 
 # import logging
 # logger = logging.getLogger('websockets')
 # logger.setLevel(logging.DEBUG)
 # logger.addHandler(logging.StreamHandler())
 
+# for starting workers, see run_supervisor
+SCRIPT_PATH = os.path.abspath(__file__)
+
 os.chdir(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.insert(0, '.')
 
+import game.game
 from game.game import *
+from game.metrics import Counter, Gauge, start_http_server
 
 WEBSOCKETS_PORT = 29782
-
-all_data = {}
+# processes pregenerating game specs for game_spec_pool
+SPEC_POOL_WORKERS = 2
+# threads running the reducers that may block, see runs_in_executor
+EXECUTOR_WORKERS = 4
+# messages whose reducers may solve a board or write to the database, so
+# they are always run off the event loop
+EXECUTOR_MSG_TYPES = ('start', 'stop')
+# messages a team may have waiting before its connections are dropped
+TEAM_QUEUE_SIZE = 200
+# teams with at least this many messages waiting are logged
+HOT_TEAM_BACKLOG = 20
+# compact frames at least this long are compressed
+COMPACT_ZLIB_THRESHOLD = 512
+# seconds between reloads of leaderboards when running as one of several
+# workers, see LEADERBOARD_RELOAD_INTERVAL
+SHARDED_LEADERBOARD_RELOAD_INTERVAL = 5
+# bytes a client may send after its handshake until its first AUTH when
+# running with workers, see hand_off
+MAX_HANDOFF_BYTES = 65536
+# seconds a connection may wait to be handed over to a worker, e.g. while
+# the worker is starting, busy or being restarted
+HANDOFF_TIMEOUT = 30
+# seconds between attempts to hand over a connection that has to wait
+HANDOFF_RETRY_INTERVAL = 0.01
+# seconds between checks that the workers are still running
+WORKER_POLL_INTERVAL = 1
+
+# team -> BoggleSession
+sessions = {}
 ws_map = {}
 ws_queues = {}
 team_map = {}
+# team -> set of its connections, kept in step with team_map
+team_conns = {}
+# connections that asked for the compact encoding, see encode_frame
+compact_conns = set()
+# connections that accept deltas, see BoggleGameState.make_word_update
+delta_conns = set()
 team_last_ping = {}
 
-def game_data_to_dict(game_data):
-    game_data['stats'] = game_data['stats'].to_dict()
-    return game_data
+# gauges are read from the metrics server's thread while the event loop
+# changes the dicts, so they iterate over copies
+Gauge('posthunt_connections', 'Open connections', func=lambda: len(ws_map))
+Gauge('posthunt_sessions', 'Teams with live state', func=lambda: len(sessions))
+Gauge(
+    'posthunt_send_queue_max', 'Longest queue of messages waiting to be sent to a connection',
+    func=lambda: max([q.qsize() for q in list(ws_queues.values())], default=0)
+)
+Gauge(
+    'posthunt_send_queue_total', 'Messages waiting to be sent to all connections',
+    func=lambda: sum([q.qsize() for q in list(ws_queues.values())])
+)
+dropped_connections = Counter(
+    'posthunt_dropped_connections_total', 'Connections dropped for falling behind'
+)
 
 def load_team_data(team):
-    c = db.cursor()
-    c.execute(' '.join([
-        'SELECT world FROM boggle_team_data',
-        'WHERE team = ?'
-    ]), (team,))
-    entry = c.fetchone()
-    if entry is not None:
-        all_data[team] = json.dumps(
-            game_data_to_dict(from_durable(json.loads(entry[0])))
-        )
+    durable_data = load_data(team)
+    if durable_data is None:
+        return None
+    return from_durable(durable_data)
 
 def load_all_data():
-    c = db.cursor()
+    get_db_writer().flush()
+    c = get_db().cursor()
     c.execute(' '.join([
         'SELECT team, world FROM boggle_team_data',
     ]))
     for entry in c.fetchall():
-        all_data[entry[0]] = json.dumps(
-            game_data_to_dict(from_durable(json.loads(entry[1])))
+        sessions[entry[0]] = BoggleSession(
+            entry[0], from_durable(json.loads(entry[1]))
         )
 
-# load_all_data()
+# Live state of a team, kept between its messages so that handling one
+# only runs the reducer. game_data is only converted to plain data when it
+# is persisted (see save_data).
+class BoggleSession:
+    def __init__(self, team, game_data=None):
+        self.team = team
+        self.game = BoggleGameState(team)
+        if game_data is None:
+            game_data = self.game.make_init()
+        self.game_data = game_data
+
+    def handle(self, msg):
+        try:
+            actions = self.game.handle(self.game_data, msg)
+        except Exception:
+            # the reducer may have changed game_data before failing, so
+            # the team goes back to its last saved state
+            self.restore()
+            raise
+        if self.game.new_game_data is not None:
+            self.game_data = self.game.new_game_data
+        return actions
 
-send_queue = []
+    def restore(self):
+        game_data = load_team_data(self.team)
+        if game_data is None:
+            game_data = self.game.make_init()
+        self.game_data = game_data
+
+    def may_block(self, msg):
+        return self.game.may_block(self.game_data, msg)
+
+def get_session(team):
+    if team not in sessions:
+        sessions[team] = BoggleSession(team, load_team_data(team))
+    return sessions[team]
+
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS)
+
+# Messages are handled by one worker task per team, fed by the team's
+# queue: a team's messages are handled in order, while other teams don't
+# wait for them (e.g. while a start is solving a board on the executor).
+# A worker exits once its queue is empty and is restarted by the next
+# message.
+#
+# Replies and broadcasts go to the team a message was queued for, as the
+# sender may have left it by the time it's handled. An AUTH to another
+# team is queued for the old one too, so it only takes effect after the
+# messages sent before it.
+# team -> asyncio.Queue of (BoggleConsumer, message or None, future set
+# when handled or None)
+team_queues = {}
+
+# Clients may ask for a compact encoding by AUTHing with
+# "encoding": "compact". They are then sent binary frames of one header
+# byte and a JSON message using COMPACT_KEYS and no whitespace:
+# - FRAME_JSON: the message as is
+# - FRAME_ZLIB: the message zlib compressed, for messages of at least
+#   COMPACT_ZLIB_THRESHOLD bytes
+# Other clients get plain JSON text frames. Messages to the server are
+# always plain JSON.
+FRAME_JSON = b'\x00'
+FRAME_ZLIB = b'\x01'
+
+# for monitoring the compact encoding
+wire_stats = {
+    'compact_frames': 0,
+    'compact_bytes': 0,
+}
+
+Counter(
+    'posthunt_compact_frames_total', 'Frames sent in the compact encoding',
+    func=lambda: wire_stats['compact_frames']
+)
+Counter(
+    'posthunt_compact_bytes_total', 'Bytes sent in the compact encoding',
+    func=lambda: wire_stats['compact_bytes']
+)
+
+def encode_frame(action, compact):
+    if not compact:
+        return action.encode()
+    msg = action.encode(compact=True).encode()
+    if len(msg) < COMPACT_ZLIB_THRESHOLD:
+        return FRAME_JSON + msg
+    return FRAME_ZLIB + zlib.compress(msg)
+
+def log_wire_stats():
+    if wire_stats['compact_frames'] > 0:
+        print('compact encoding: %d frames, %d bytes' % (
+            wire_stats['compact_frames'], wire_stats['compact_bytes']
+        ))
+
+# moves connection clid to team, or removes it from its team if None
+def set_team(clid, team):
+    old_team = team_map.pop(clid, None)
+    if old_team is not None:
+        team_conns[old_team].discard(clid)
+        if len(team_conns[old_team]) == 0:
+            del team_conns[old_team]
+    if team is not None:
+        team_map[clid] = team
+        team_conns.setdefault(team, set()).add(clid)
+
+# other messages also run off the event loop when they may block: if
+# the team's session has to be loaded from the database, or see
+# BoggleGameState.may_block
+def runs_in_executor(team, msg):
+    if msg.get('type') in EXECUTOR_MSG_TYPES:
+        return True
+    if team not in sessions:
+        return True
+    return sessions[team].may_block(msg)
+
+# team -> number of messages waiting to be handled, for finding hot teams
+def get_team_backlogs():
+    return {team: q.qsize() for team, q in list(team_queues.items())}
+
+Gauge(
+    'posthunt_team_backlog_max', 'Most messages a team has waiting to be handled',
+    func=lambda: max(get_team_backlogs().values(), default=0)
+)
+Gauge(
+    'posthunt_team_backlog_total', 'Messages waiting to be handled for all teams',
+    func=lambda: sum(get_team_backlogs().values())
+)
+
+async def run_team_queue(team, q):
+    while not q.empty():
+        consumer, msg, done = q.get_nowait()
+        try:
+            if msg is None:
+                # only marks when the messages queued before are handled
+                pass
+            elif msg.get('type') == 'AUTH':
+                consumer.authenticate(msg)
+            elif runs_in_executor(team, msg):
+                actions = await asyncio.get_event_loop().run_in_executor(
+                    executor, consumer.handle_txn, team, msg
+                )
+                consumer.perform_actions(team, actions)
+            else:
+                actions = consumer.handle_txn(team, msg)
+                consumer.perform_actions(team, actions)
+        except Exception as e:
+            print('error handling %s for %s: %r' % (
+                msg.get('type'), urllib.parse.quote(team), e
+            ))
+        if done is not None:
+            done.set_result(None)
+        log_num_active_games()
+        # let other teams' workers run
+        await asyncio.sleep(0)
+    del team_queues[team]
 
 class BoggleConsumer():
     def __init__(self, channel_name):
         self.channel_name = channel_name
 
-    def handle_txn(self, msg, clid=None):
-        global all_data, team_map
-
-        if clid is None:
-            clid = self.channel_name
-
-        if not isinstance(msg, dict):
-            return []
-        if 'type' in msg and msg['type'] == 'AUTH':
-            if 'data' in msg:
-                team_map[clid] = msg['data'][:256]
-            return []
-        if clid not in team_map:
-            return []
-        team = team_map[clid]
+    def handle_txn(self, team, msg):
         team_last_ping[team] = datetime.datetime.now()
-
-        game = BoggleGameState(team)
-
-        game_data_valid = False
-        if team not in all_data:
-            load_team_data(team)
-        if team in all_data:
-            try:
-                game_data = json.loads(all_data[team])
-                stats = BoggleStats()
-                stats.from_dict(game_data['stats'])
-                game_data['stats'] = stats
-                game_data_valid = True
-            except Exception as e:
-                game_data = {}
-
-        if not game_data_valid:
-            game_data = game.make_init()
-
-        actions = game.handle(game_data, msg)
-
-        if game.new_game_data is not None:
-            game_data = game.new_game_data
-            game_data['stats'] = game_data['stats'].to_dict()
-            all_data[team] = json.dumps(game_data)
-
-        return actions
+        return get_session(team).handle(msg)
 
     def perform_send(self, msg, clid):
-        ws_queues[clid].put_nowait(json.dumps(msg))
+        ws_queues[clid].put_nowait(msg)
         if ws_queues[clid].qsize() > 200:
+            # counted once, when the queue first gets too long
+            if ws_queues[clid].qsize() == 201:
+                dropped_connections.inc()
             asyncio.create_task(ws_map[clid].close())
 
-    def perform_actions(self, actions, clid):
+    # performs the actions of a message handled for team
+    def perform_actions(self, team, actions):
+        clid = self.channel_name
         for action in actions:
-            if clid not in team_map:
-                continue
-            team = team_map[clid]
             if not action.broadcast:
-                self.perform_send(action.data, clid)
-            else:
-                targets = [
-                    ocl for ocl, oteam in team_map.items()
-                    if oteam == team
-                ]
-                for ocl in targets:
-                    self.perform_send(action.data, ocl)
-
-    def process_send_queue(self):
-        global send_queue
-        while len(send_queue) > 0:
-            msg_data = send_queue[0]
-            send_queue = send_queue[1:]
-            if msg_data[2] == 'disconnect':
-                # print(msg_data[1] + ' disconnected')
-                # self.handle_disconnect(msg_data[1])
-                actions = []
+                if team_map.get(clid) != team:
+                    # the sender left the team since
+                    continue
+                targets = [clid]
             else:
-                # print('received ' + str(msg_data[2]) + ' from ' + msg_data[1])
-                actions = self.handle_txn(msg_data[2], msg_data[1])
-            self.perform_actions(actions, msg_data[1])
+                targets = team_conns.get(team, ())
+                if action.deltas is not None:
+                    targets = [
+                        ocl for ocl in targets if (ocl in delta_conns) == action.deltas
+                    ]
+            # encoded once per encoding, the same frame is queued for all
+            frames = {}
+            num_compact = 0
+            for ocl in targets:
+                compact = ocl in compact_conns
+                if compact not in frames:
+                    frames[compact] = encode_frame(action, compact)
+                if compact:
+                    num_compact += 1
+                self.perform_send(frames[compact], ocl)
+            if num_compact > 0:
+                wire_stats['compact_frames'] += num_compact
+                wire_stats['compact_bytes'] += num_compact * len(frames[True])
+
+    def authenticate(self, msg):
+        clid = self.channel_name
+        if 'data' in msg:
+            set_team(clid, msg['data'][:256])
+        if msg.get('encoding') == 'compact':
+            compact_conns.add(clid)
+        else:
+            compact_conns.discard(clid)
+        if msg.get('deltas') == DELTA_VERSION:
+            delta_conns.add(clid)
+        else:
+            delta_conns.discard(clid)
+
+    # queues msg for team, and returns whether it could be
+    def enqueue(self, team, msg, done=None):
+        clid = self.channel_name
+        if team not in team_queues:
+            team_queues[team] = asyncio.Queue(maxsize=TEAM_QUEUE_SIZE)
+            asyncio.create_task(run_team_queue(team, team_queues[team]))
+        try:
+            team_queues[team].put_nowait((self, msg, done))
+        except asyncio.QueueFull:
+            print('backlog of %s full, disconnecting %s' % (
+                urllib.parse.quote(team), clid
+            ))
+            asyncio.create_task(ws_map[clid].close())
+            return False
+        if team_queues[team].qsize() == HOT_TEAM_BACKLOG:
+            print('backlog of %s at %d messages' % (
+                urllib.parse.quote(team), HOT_TEAM_BACKLOG
+            ))
+        return True
+
+    async def dispatch(self, msg):
+        clid = self.channel_name
+        if not isinstance(msg, dict):
+            return
+        if 'type' in msg and msg['type'] == 'AUTH':
+            if clid not in team_map:
+                self.authenticate(msg)
+                return
+            # the connection's next messages wait until it has switched
+            done = asyncio.get_event_loop().create_future()
+            if self.enqueue(team_map[clid], msg, done):
+                await done
+            return
+        if clid not in team_map:
+            return
+        self.enqueue(team_map[clid], msg)
 
-    def disconnected(self):
-        global send_queue
-        send_queue += [(
-            datetime.datetime.now(),
-            self.channel_name,
-            'disconnect'
-        )]
-        self.process_send_queue()
+    # hands the connection over to the worker of the team it AUTHed as
+    # (see HandedOffProtocol), ending it here
+    async def move(self, ws):
+        clid = self.channel_name
+        try:
+            await asyncio.wait_for(self.hand_over(ws), HANDOFF_TIMEOUT)
+        except (OSError, asyncio.TimeoutError) as e:
+            print('failed to move connection %s: %r' % (clid, e))
+        finally:
+            # without a close frame, as the client stays connected
+            ws.transport.abort()
+            if not ws.moved.done():
+                ws.moved.set_exception(ConnectionResetError())
+
+    async def hand_over(self, ws):
+        clid = self.channel_name
+        loop = asyncio.get_event_loop()
+        # the messages sent before the AUTH are handled first
+        if clid in team_map:
+            done = loop.create_future()
+            if not self.enqueue(team_map[clid], None, done):
+                return
+            await done
+        # and their replies written, so they aren't interleaved with the
+        # other worker's
+        written = loop.create_future()
+        ws_queues[clid].put_nowait(written)
+        await written
+        while ws.transport.get_write_buffer_size() > 0:
+            await asyncio.sleep(HANDOFF_RETRY_INTERVAL)
+        # the AUTH, followed by what the client sent after it, which is
+        # still in the reader's buffer or the socket
+        data = websockets.frames.Frame(
+            websockets.frames.Opcode.TEXT, ws.moving_auth.encode()
+        ).serialize(mask=True) + bytes(ws.reader._buffer)
+        if len(data) > MAX_HANDOFF_BYTES:
+            print('not moving connection %s, too much data' % (clid,))
+            return
+        worker = get_team_worker(get_auth_team(ws.moving_auth), shard[1])
+        msg = MOVE_HEADER.pack(worker) + pack_handoff(ws.extensions, data)
+        await send_handoff([handoff_socket], 0, msg, ws.transport.get_extra_info('socket'))
+        moves_total.inc()
 
-    def handle(self, msg):
-        global send_queue
+    def disconnected(self):
+        # print(self.channel_name + ' disconnected')
+        # self.handle_disconnect(self.channel_name)
+        pass
+
+    async def handle(self, msg):
+        ws = ws_map[self.channel_name]
+        if shard is not None and msg is ws.moving_auth:
+            # the AUTH reading stopped at, now that what came before it
+            # has been dispatched
+            await self.move(ws)
+            return
         try:
             msg_data = json.loads(msg)
-        except JSONDecodeError:
-            return;
-        send_queue += [(
-            datetime.datetime.now(),
-            self.channel_name,
-            msg_data
-        )]
-        self.process_send_queue()
+        except json.JSONDecodeError:
+            return
+        # print('received ' + str(msg_data) + ' from ' + self.channel_name)
+        await self.dispatch(msg_data)
 
 old_active_games_str = ''
 
 def log_num_active_games():
     global old_active_games_str
     new_active_games_str = str([
-        urllib.parse.quote(team) for team in all_data.keys()
+        urllib.parse.quote(team) for team in list(sessions)
     ])
     if new_active_games_str != old_active_games_str:
         old_active_games_str = new_active_games_str
@@ -187,6 +450,10 @@ async def send_from_queue(q, ws):
             msg = await q.get()
             if msg is None:
                 break
+            if isinstance(msg, asyncio.Future):
+                # set once the messages queued before are sent
+                msg.set_result(None)
+                continue
             await ws.send(msg)
         except websockets.exceptions.ConnectionClosedError:
             break
@@ -197,21 +464,23 @@ connections_cnt = 0
 
 def purge_idle_teams():
     team_not_idle = set()
-    for team in team_map.values():
+    for team in team_conns:
+        team_not_idle.add(team)
+    for team in team_queues:
         team_not_idle.add(team)
-    all_teams = list(all_data.keys())
-    old_num_teams = len(all_data)
+    all_teams = list(sessions)
+    old_num_teams = len(sessions)
     for team in all_teams:
         if team in team_not_idle:
             continue
         if team not in team_last_ping:
-            if team in all_data:
-                del all_data[team]
+            if team in sessions:
+                del sessions[team]
             continue
         PING_TIMEOUT = datetime.timedelta(minutes=5)
         if datetime.datetime.now() - team_last_ping[team] < PING_TIMEOUT:
             continue
-        del all_data[team]
+        del sessions[team]
         del team_last_ping[team]
     log_num_active_games()
 
@@ -219,37 +488,437 @@ async def purge_idle_teams_loop():
     while True:
         await asyncio.sleep(5 * 60)
         purge_idle_teams()
-
-def make_websockets():
-    async def on_connect(ws, path):
-        global connections_cnt
-        name = str(connections_cnt)
-        connections_cnt += 1
-        ws_map[name] = ws
-        ws_queues[name] = asyncio.Queue()
-        asyncio.create_task(send_from_queue(ws_queues[name], ws))
-        try:
-            async for m in ws:
-                # print(m)
-                BoggleConsumer(name).handle(m)
-                log_num_active_games()
-        except websockets.exceptions.ConnectionClosedError:
-            pass
-        finally:
-            BoggleConsumer(name).disconnected()
-            if name in ws_map:
-                del ws_map[name]
-            if name in team_map:
-                del team_map[name]
-            if name in ws_queues:
-                ws_queues[name].put_nowait(None)
-                del ws_queues[name]
-            log_num_active_games()
-
-    start_server = websockets.serve(on_connect, 'localhost', WEBSOCKETS_PORT)
+        log_wire_stats()
+
+async def on_connect(ws, path):
+    global connections_cnt
+    name = str(connections_cnt)
+    connections_cnt += 1
+    ws_map[name] = ws
+    ws_queues[name] = asyncio.Queue()
+    asyncio.create_task(send_from_queue(ws_queues[name], ws))
+    consumer = BoggleConsumer(name)
+    try:
+        async for m in ws:
+            # print(m)
+            await consumer.handle(m)
+    except websockets.exceptions.ConnectionClosedError:
+        pass
+    finally:
+        consumer.disconnected()
+        if name in ws_map:
+            del ws_map[name]
+        set_team(name, None)
+        compact_conns.discard(name)
+        delta_conns.discard(name)
+        if name in ws_queues:
+            ws_queues[name].put_nowait(None)
+            del ws_queues[name]
+        log_num_active_games()
+
+def make_websockets(port):
+    start_server = websockets.serve(on_connect, 'localhost', port)
     asyncio.get_event_loop().run_until_complete(start_server)
 
-make_websockets()
-asyncio.get_event_loop().create_task(purge_idle_teams_loop())
-print('server started')
-asyncio.get_event_loop().run_forever()
+# metrics server started by this process, if any
+metrics_server = None
+
+# run in the spec pool's processes, which are forked with copies of these
+# sockets: a worker's unix socket to the supervisor must break when the
+# worker exits (see send_handoff), and its metrics port be free for the
+# worker replacing it
+def close_inherited_sockets():
+    if handoff_socket is not None:
+        handoff_socket.close()
+    if metrics_server is not None:
+        metrics_server.socket.close()
+
+# port is None for workers, which get their connections through handoff
+def run_server(port, compaction=True, handoff=None):
+    # opened now rather than by the first write of a reducer run on the
+    # event loop
+    get_db_writer()
+    game_spec_pool.start(concurrent.futures.ProcessPoolExecutor(
+        max_workers=SPEC_POOL_WORKERS, initializer=close_inherited_sockets
+    ))
+    if compaction:
+        start_db_compaction()
+    if port is not None:
+        make_websockets(port)
+    if handoff is not None:
+        receive_handoffs(handoff)
+    asyncio.get_event_loop().create_task(purge_idle_teams_loop())
+    # stop on SIGTERM like on ^C, so buffered writes are flushed
+    asyncio.get_event_loop().add_signal_handler(
+        signal.SIGTERM, asyncio.get_event_loop().stop
+    )
+    if port is not None:
+        print('server started on port %d' % (port,))
+    else:
+        print('worker %d started' % (shard[0],))
+    try:
+        asyncio.get_event_loop().run_forever()
+    finally:
+        close_db_writer()
+
+# With --workers N, this process only accepts connections and hands each
+# one over to one of N worker processes (this script run with --worker i),
+# picked by the hash of the team it AUTHs as. Every team is owned by one
+# worker, which alone holds its state and writes its rows, so throughput
+# scales with cores while the workers share nothing but the databases.
+# Workers that exit are restarted.
+#
+# The supervisor does the websocket handshake and reads what the client
+# sends until its first AUTH, then passes the socket and those bytes to
+# the worker over a unix socket (SCM_RIGHTS). The worker reads the bytes
+# as if they had just arrived, and from then on talks to the client
+# directly.
+#
+# A connection that later AUTHs as a team of another worker is moved
+# there the same way: its worker stops reading at that AUTH, and once
+# what came before is handled, passes the socket, the AUTH and what
+# followed it back to the supervisor for the other worker.
+#
+# permessage-deflate is negotiated by the supervisor and its parameters
+# are passed along with the socket. Clients are asked not to take over
+# their compression context between messages, so the worker a connection
+# is moved to can decompress what follows the AUTH.
+#
+# A handoff message is HANDOFF_HEADER (whether permessage-deflate is used,
+# and its remote and local no_context_takeover and max_window_bits), then
+# the bytes to be read. Workers prefix the handoff messages of connections
+# they move with MOVE_HEADER, the worker to move them to.
+HANDOFF_HEADER = struct.Struct('!???BB')
+MOVE_HEADER = struct.Struct('!H')
+# like the defaults of websockets.serve
+DEFLATE_COMPRESS_SETTINGS = {'memLevel': 5}
+DEFLATE_FACTORY = ServerPerMessageDeflateFactory(
+    server_max_window_bits=12,
+    client_max_window_bits=12,
+    client_no_context_takeover=True,
+    compress_settings=DEFLATE_COMPRESS_SETTINGS,
+)
+
+# (worker, number of workers) when running as a worker
+shard = None
+# a worker's unix socket to the supervisor
+handoff_socket = None
+
+def get_team_worker(team, num_workers):
+    return zlib.crc32(str(team).encode()) % num_workers
+
+# the team msg AUTHs as, or None if it's no AUTH
+def get_auth_team(msg):
+    # most messages can be passed on without decoding them
+    if not isinstance(msg, str) or 'AUTH' not in msg:
+        return None
+    try:
+        msg_data = json.loads(msg)
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(msg_data, dict) or msg_data.get('type') != 'AUTH':
+        return None
+    if 'data' not in msg_data:
+        return None
+    return msg_data['data'][:256]
+
+handoffs_total = Counter(
+    'posthunt_handoffs_total', 'Connections handed over to workers', ['worker']
+)
+moves_total = Counter(
+    'posthunt_moves_total', 'Connections moved to another worker'
+)
+
+def pack_handoff(extensions, data):
+    for extension in extensions:
+        if isinstance(extension, PerMessageDeflate):
+            return HANDOFF_HEADER.pack(
+                True,
+                extension.remote_no_context_takeover,
+                extension.local_no_context_takeover,
+                extension.remote_max_window_bits,
+                extension.local_max_window_bits,
+            ) + data
+    return HANDOFF_HEADER.pack(False, False, False, 0, 0) + data
+
+# returns the extensions and data of a handoff message
+def unpack_handoff(msg):
+    (
+        deflate, remote_no_context_takeover, local_no_context_takeover,
+        remote_max_window_bits, local_max_window_bits,
+    ) = HANDOFF_HEADER.unpack_from(msg)
+    extensions = []
+    if deflate:
+        extensions.append(PerMessageDeflate(
+            remote_no_context_takeover, local_no_context_takeover,
+            remote_max_window_bits, local_max_window_bits,
+            DEFLATE_COMPRESS_SETTINGS,
+        ))
+    return extensions, msg[HANDOFF_HEADER.size:]
+
+# sends msg and the socket conn over handoffs[worker], retrying while the
+# unix socket is full (the worker is starting or busy) or broken (the
+# worker is being restarted, which replaces handoffs[worker])
+async def send_handoff(handoffs, worker, msg, conn):
+    while True:
+        try:
+            socket.send_fds(handoffs[worker], [msg], [conn.fileno()])
+            return
+        except (BlockingIOError, BrokenPipeError, ConnectionResetError):
+            await asyncio.sleep(HANDOFF_RETRY_INTERVAL)
+
+async def forward_handoff(handoffs, worker, msg, conn):
+    try:
+        await asyncio.wait_for(send_handoff(handoffs, worker, msg, conn), HANDOFF_TIMEOUT)
+        handoffs_total.inc(worker)
+    except (OSError, asyncio.TimeoutError) as e:
+        print('failed to hand off connection: %r' % (e,))
+    finally:
+        # the worker has its own copy
+        conn.close()
+
+# does the handshake of conn and reads until the first AUTH, then sends
+# conn to the team's worker
+async def hand_off(conn, handoffs):
+    loop = asyncio.get_event_loop()
+    # only parses, what it would send is dropped
+    protocol = websockets.server.ServerConnection(
+        extensions=[DEFLATE_FACTORY], max_size=MAX_HANDOFF_BYTES
+    )
+    received = b''
+    # where the client's frames start in received
+    frames_start = None
+    team = None
+    try:
+        while team is None:
+            data = await loop.sock_recv(conn, MAX_HANDOFF_BYTES)
+            if data == b'':
+                return
+            received += data
+            if frames_start is not None and len(received) - frames_start > MAX_HANDOFF_BYTES:
+                return
+            protocol.receive_data(data)
+            for event in protocol.events_received():
+                if frames_start is None:
+                    # the request; nothing follows it until it's answered
+                    response = protocol.accept(event)
+                    protocol.send_response(response)
+                    await loop.sock_sendall(conn, response.serialize())
+                    if response.status_code != 101:
+                        return
+                    frames_start = received.index(b'\r\n\r\n') + 4
+                elif event.opcode == websockets.frames.Opcode.CLOSE:
+                    return
+                elif event.opcode == websockets.frames.Opcode.TEXT and event.fin:
+                    team = get_auth_team(event.data.decode())
+                    if team is not None:
+                        break
+            if protocol.parser_exc is not None:
+                return
+        worker = get_team_worker(team, len(handoffs))
+        msg = pack_handoff(protocol.extensions, received[frames_start:])
+        await forward_handoff(handoffs, worker, msg, conn)
+    except (OSError, UnicodeDecodeError) as e:
+        print('failed to hand off connection: %r' % (e,))
+    finally:
+        conn.close()
+
+async def accept_connections(listener, handoffs):
+    loop = asyncio.get_event_loop()
+    while True:
+        conn, addr = await loop.sock_accept(listener)
+        asyncio.create_task(hand_off(conn, handoffs))
+
+# A connection handed over by the supervisor, whose handshake is done;
+# data, what the client sent since, is received again first. Reading
+# stops at an AUTH as a team of another worker, which leaves what follows
+# it unread for BoggleConsumer.move.
+class HandedOffProtocol(websockets.legacy.server.WebSocketServerProtocol):
+    def __init__(self, extensions, data, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.handed_off_extensions = extensions
+        self.handed_off_data = data
+        # the text of that AUTH
+        self.moving_auth = None
+        # failed once the connection is moved, which ends it here
+        self.moved = None
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        self.data_received(self.handed_off_data)
+
+    async def handshake(self, *args, **kwargs):
+        self.path = '/'
+        self.extensions = self.handed_off_extensions
+        self.connection_open()
+        return self.path
+
+    async def read_message(self):
+        if self.moved is not None:
+            await self.moved
+        message = await super().read_message()
+        team = get_auth_team(message)
+        if team is not None and get_team_worker(team, shard[1]) != shard[0]:
+            self.transport.pause_reading()
+            self.moving_auth = message
+            self.moved = self.loop.create_future()
+        return message
+
+# serves the connections the supervisor sends over the unix socket handoff
+def receive_handoffs(handoff):
+    loop = asyncio.get_event_loop()
+    ws_server = websockets.legacy.server.WebSocketServer()
+    handoff.setblocking(False)
+
+    def on_readable():
+        while True:
+            try:
+                msg, fds, flags, addr = socket.recv_fds(
+                    handoff, HANDOFF_HEADER.size + MAX_HANDOFF_BYTES, 1
+                )
+            except BlockingIOError:
+                return
+            if len(fds) == 0:
+                # the supervisor is gone
+                loop.remove_reader(handoff)
+                return
+            conn = socket.socket(fileno=fds[0])
+            conn.setblocking(False)
+            extensions, data = unpack_handoff(msg)
+            loop.create_task(loop.connect_accepted_socket(
+                functools.partial(HandedOffProtocol, extensions, data, on_connect, ws_server),
+                conn
+            ))
+
+    loop.add_reader(handoff, on_readable)
+
+# workers serve their metrics on the ports after the supervisor's
+def get_worker_metrics_port(metrics_port, worker):
+    return metrics_port + 1 + worker
+
+# forwards the connections worker moves to other workers
+def receive_moves(handoffs, worker):
+    loop = asyncio.get_event_loop()
+    handoff = handoffs[worker]
+
+    def on_readable():
+        while True:
+            try:
+                msg, fds, flags, addr = socket.recv_fds(
+                    handoff, MOVE_HEADER.size + HANDOFF_HEADER.size + MAX_HANDOFF_BYTES, 1
+                )
+            except BlockingIOError:
+                return
+            except OSError:
+                msg, fds = b'', []
+            if len(fds) == 0:
+                # the worker is gone, see watch_workers
+                loop.remove_reader(handoff)
+                return
+            conn = socket.socket(fileno=fds[0])
+            to_worker, = MOVE_HEADER.unpack_from(msg)
+            loop.create_task(forward_handoff(
+                handoffs, to_worker, msg[MOVE_HEADER.size:], conn
+            ))
+
+    loop.add_reader(handoff, on_readable)
+
+# returns the process of worker and the unix socket to it; the worker
+# gets a process group of its own, see watch_workers
+def start_worker(worker, num_workers, worker_args):
+    handoff, worker_handoff = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    handoff.setblocking(False)
+    process = subprocess.Popen([
+        sys.executable, SCRIPT_PATH,
+        '--worker', str(worker), '--workers', str(num_workers),
+        '--handoff-fd', str(worker_handoff.fileno()),
+    ] + worker_args, pass_fds=[worker_handoff.fileno()], process_group=0)
+    worker_handoff.close()
+    return process, handoff
+
+# restarts the workers that exit, with new unix sockets; connections
+# waiting for one are handed to its replacement
+async def watch_workers(workers, handoffs, worker_args):
+    loop = asyncio.get_event_loop()
+    while True:
+        await asyncio.sleep(WORKER_POLL_INTERVAL)
+        for worker, process in enumerate(workers):
+            if process.poll() is None:
+                continue
+            print('worker %d exited with status %d, restarting it' % (
+                worker, process.returncode
+            ))
+            # its spec pool processes would otherwise outlive it, keeping
+            # e.g. its metrics port
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            loop.remove_reader(handoffs[worker])
+            handoffs[worker].close()
+            workers[worker], handoffs[worker] = start_worker(
+                worker, len(workers), worker_args
+            )
+            receive_moves(handoffs, worker)
+
+def run_supervisor(num_workers, metrics_port=None):
+    # bound first, so if that fails no workers are left behind
+    listener = socket.create_server(('localhost', WEBSOCKETS_PORT))
+    listener.setblocking(False)
+    worker_args = []
+    if metrics_port is not None:
+        worker_args = ['--metrics-port', str(metrics_port)]
+    workers = []
+    # one unix socket per worker; connections wait in it while the worker
+    # is starting
+    handoffs = []
+    try:
+        for worker in range(num_workers):
+            process, handoff = start_worker(worker, num_workers, worker_args)
+            workers.append(process)
+            handoffs.append(handoff)
+        for worker in range(num_workers):
+            receive_moves(handoffs, worker)
+        asyncio.get_event_loop().create_task(accept_connections(listener, handoffs))
+        asyncio.get_event_loop().create_task(watch_workers(workers, handoffs, worker_args))
+        asyncio.get_event_loop().add_signal_handler(
+            signal.SIGTERM, asyncio.get_event_loop().stop
+        )
+        print('handing connections over to %d workers' % (num_workers,))
+        asyncio.get_event_loop().run_forever()
+    finally:
+        # workers flush their writes on SIGTERM
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.wait()
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--workers', type=int, default=0,
+    help='number of worker processes teams are spread over')
+parser.add_argument('--worker', type=int, default=None,
+    help='run as the given worker, started by the supervisor')
+parser.add_argument('--handoff-fd', type=int, default=None,
+    help='unix socket a worker gets its connections from')
+parser.add_argument('--metrics-port', type=int, default=None,
+    help='serve metrics in the Prometheus text format on this port')
+args = parser.parse_args()
+
+if args.worker is not None:
+    if args.metrics_port is not None:
+        metrics_server = start_http_server(
+            get_worker_metrics_port(args.metrics_port, args.worker)
+        )
+    shard = (args.worker, args.workers)
+    handoff_socket = socket.socket(fileno=args.handoff_fd)
+    # other workers set hiscores too
+    game.game.LEADERBOARD_RELOAD_INTERVAL = SHARDED_LEADERBOARD_RELOAD_INTERVAL
+    run_server(None, compaction=args.worker == 0, handoff=handoff_socket)
+elif args.workers > 0:
+    if args.metrics_port is not None:
+        metrics_server = start_http_server(args.metrics_port)
+    run_supervisor(args.workers, args.metrics_port)
+else:
+    if args.metrics_port is not None:
+        metrics_server = start_http_server(args.metrics_port)
+    run_server(WEBSOCKETS_PORT)